@@ -1,14 +1,12 @@
-import json
 import os
 
 import click
 from metrics import *
 from predict import method_name
 from utils.hash_utils import hash_dir
-from utils.metrics_utils import calc_metrics, calc_mean_metrics
-
-dump_dir = os.path.join('..', 'dumps')
-dump_filename = os.path.join(dump_dir, 'metrics_{}_{}.json')
+from utils.metrics_utils import (calc_mean_metrics, calc_metrics, dump_dir,
+                                 dump_metrics)
+from utils.skin_model import default_threshold
 
 @click.group()
 def cli_measure():
@@ -19,23 +17,28 @@ def cli_measure():
               type=click.Path(exists=True), required=True,
               help = 'Path to the folder containing the predictions dir (eg. ECU_on_Schmugge)')
 @click.option('--dump/--no-dump', '-d', default=False, help = 'Whether to dump results to files')
-def eval(path, dump):
+@click.option('--threshold', '-t', type=float, multiple=True,
+              help = f'Skin probability threshold binarizing probability maps (default is {default_threshold}, '
+                     'not the one used when predicting). Repeat to measure many thresholds')
+def eval(path, dump, threshold):
     # Define metric functions used to evaluate
     #metrics = [f1_m, f1fin, f2fin, iou, dprs_m, mcc, recall, precision, specificity]
-    metrics = [f1_medium, f1, f2, iou, iou_logical, dprs_medium, dprs, mcc, recall, precision, specificity]
+    metrics = eval_metrics
 
     # Get folders containing grountruth and prediction IMAGES
     y_path = os.path.join(path, 'y') # Path eg. 'predictions/HGR_small_on_ECU/y'
     p_path = os.path.join(path, 'p') # Path eg. 'predictions/HGR_small_on_ECU/p'
 
-    singles = calc_metrics(y_path, p_path, metrics)
-    avg = calc_mean_metrics(singles, metrics, desc=path + ' with hash=' + hash_dir(path), method=method_name)
-
-    if dump:
-        path_bn = os.path.basename(os.path.normpath(path))
-        os.makedirs(dump_dir, exist_ok=True)
-
-        with open(dump_filename.format(path_bn, 'average'), 'w') as f:
-            json.dump(avg, f, sort_keys = True, indent = 4)
-        with open(dump_filename.format(path_bn, 'singles'), 'w') as f:
-            json.dump(singles, f, sort_keys = True, indent = 4)
+    # probability maps are binarized at each threshold, masks are already binary
+    for p_threshold in threshold or (default_threshold,):
+        desc = path + ' with hash=' + hash_dir(path)
+        if threshold:
+            desc += f' at threshold={p_threshold}'
+        singles = calc_metrics(y_path, p_path, metrics, p_threshold=p_threshold)
+        avg = calc_mean_metrics(singles, metrics, desc=desc, method=method_name)
+
+        if dump:
+            path_bn = os.path.basename(os.path.normpath(path))
+            if threshold:
+                path_bn += f'_t{p_threshold}'
+            dump_metrics(path_bn, avg, singles)
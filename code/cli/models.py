@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import click
+from train import combine_models
+from utils.db_utils import get_db_by_name, get_model_filename, skin_databases_names
+from utils.histograms import counts_filename
+from utils.logmanager import *
+from utils.skin_model import convert_model
+
+
+@click.group()
+def cli_models():
+    pass
+
+@cli_models.command(short_help='Convert CSV models into the native model format')
+@click.option('--model', '-m', 'models', multiple=True,
+              type=click.Choice(skin_databases_names(), case_sensitive=False), required=True,
+              help = 'Models to convert (eg. -m ECU -m HGR_small)')
+@click.option('--dtype', type=click.Choice(['float32', 'float64']), default='float32', show_default=True,
+              help = 'Data type of the probabilities LUT')
+def convert(models, dtype):
+    for m in models:
+        db = get_db_by_name(m)
+        csv_model, native_model = get_model_filename(db, 'csv'), get_model_filename(db, 'npy')
+        header = convert_model(csv_model, native_model, dtype=dtype)
+        # same data: the counts saved by training the CSV model are the ones of the native model
+        if os.path.isfile(counts_filename(csv_model)):
+            shutil.copyfile(counts_filename(csv_model), counts_filename(native_model))
+        info(f'Model {m} converted with hash={header["hash"]}')
+
+def model_base(name: str) -> str:
+    '''Return the model filename used for predictions by a dataset, whose counts are read by `load_model_counts`'''
+    return get_model_filename(get_db_by_name(name))
+
+@cli_models.command(short_help='Build a model summing the counts of other models')
+@click.option('--model', '-m', 'models', multiple=True,
+              type=click.Choice(skin_databases_names(), case_sensitive=False), required=True,
+              help = 'Models to merge (eg. -m ECU -m HGR_small)')
+@click.option('--weight', '-w', 'weights', multiple=True, type=float,
+              help = 'Weight of each model, in the same order (default is 1 for all)')
+@click.option('--out', '-o', type=click.Path(exists=False), required=True,
+              help = 'Filename of the new model, its extension gives the format (eg. ../models/ECU+HGR.npz)')
+def merge(models, weights, out):
+    '''
+    MERGE: new model from the sum of skin and non skin counts of trained models.
+    Counts are read from sparse models (npz), or from the counts saved by training them.
+    '''
+    if not weights:
+        weights = [1] * len(models)
+    combine_models([model_base(m) for m in models], list(weights), out)
+    info(f'Model {out} built from {", ".join(models)}')
+
+@cli_models.command(short_help='Build a model subtracting the counts of other models')
+@click.option('--model', '-m', type=click.Choice(skin_databases_names(), case_sensitive=False), required=True,
+              help = 'Model to subtract from')
+@click.option('--subtract', '-s', 'subtracted', multiple=True,
+              type=click.Choice(skin_databases_names(), case_sensitive=False), required=True,
+              help = 'Models to subtract (eg. -s dark -s light)')
+@click.option('--weight', '-w', 'weights', multiple=True, type=float,
+              help = 'Weight of each subtracted model, in the same order (default is 1 for all)')
+@click.option('--out', '-o', type=click.Path(exists=False), required=True,
+              help = 'Filename of the new model, its extension gives the format (eg. ../models/Schmugge-dark.npz)')
+def subtract(model, subtracted, weights, out):
+    '''
+    SUBTRACT: new model from the skin and non skin counts of a trained model minus other models.
+    Counts are read from sparse models (npz), or from the counts saved by training them.
+    '''
+    if not weights:
+        weights = [1] * len(subtracted)
+    combine_models([model_base(m) for m in (model, *subtracted)], [1] + [-w for w in weights], out)
+    info(f'Model {out} built from {model} minus {", ".join(subtracted)}')
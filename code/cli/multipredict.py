@@ -1,253 +1,308 @@
+import shlex
 import subprocess
-import time
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from math import ceil
 
 import click
-import psutil
+from pool import run_tasks
+from predict import progress_prefix
+from tqdm import tqdm
+from utils.cost_utils import determine_workers, get_megapixels
 from utils.db_utils import *
 from utils.logmanager import *
+from utils.skin_model import default_threshold, share_model, unshare_model
 
 # Parallelize the predictions by calling predict.py multiple times
 
 
 cmd_root = 'python main.py single '
-
-def determine_workers(workers: int) -> int:
-    '''
-    If workers == -1, number of workers is equal to the
-    number of system's physical cores
-    '''
-    if workers == -1:
-        workers = psutil.cpu_count(logical=False)
-    return workers
-
-def determine_tasks_per_db(db_sizes: dict, workload: int,
-                                total_db_size: int, debug: bool) -> dict:
+# Available execution engines
+engines = ('pool', 'subprocess')
+# Available schedulers for the pool engine
+schedulers = ('dynamic', 'static')
+# Aim for tasks smaller than this many megapixels to infer on
+max_task_megapixels = 100
+
+def determine_tasks_per_db(db_costs: dict, workload: float) -> dict:
     '''
-    Try to assign a proper number of tasks per each dataset
+    Assign a number of tasks to each dataset, proportional to its cost
 
-    eg: Workload = 300.
-        : If db1 has 200  images  -> 1 task
-        : If db2 has 1000 images  -> 4 tasks
+    eg: Workload = 90 megapixels.
+        : If db1 has 200 images of 0.3 MP  -> 1 task
+        : If db2 has 1000 images of 0.3 MP -> 4 tasks
     
-    Return a dict containing each db with their size and tasks assigned
+    Return a dict containing each db with the number of tasks assigned
     '''
-    remaining_tasks = total_db_size // workload
-    
-    while remaining_tasks > 0:
-        # copy because it is being edited in the loop
-        for entry in db_sizes.copy():
-            if debug:
-                info(db_sizes)
-                info(remaining_tasks)
-            # Just consider db entries, not tasks-related ones
-            if entry[-1] == 'w': # (if string ending with 'w')
-                continue
-
-            key = entry+'w' # key containing db + number of tasks (eg. ECUw : 1)
-
-            if remaining_tasks != 0:
-                # db need more work than a workload unit
-                if db_sizes[entry] > workload:
-                    # Add a task
-                    if key in db_sizes:
-                        db_sizes[key] = int(db_sizes[key]) + 1
-                    else:
-                        db_sizes[key] = 1
-                    remaining_tasks = remaining_tasks -1
-                # A workload unit is enough
-                else:
-                    # If all work needed in current db is already assigned, continue
-                    if key in db_sizes and db_sizes[key] == 1:
-                        continue
-
-                    # Add a task
-                    db_sizes[key] = 1
-                    remaining_tasks = remaining_tasks -1
-            else:
-                break
-    return db_sizes
+    return {db: max(1, ceil(sum(costs) / workload)) for db, costs in db_costs.items()}
 
 def calculate_workload(models: list, workers: int, use_only_test_set: bool = False) -> list:
     '''
-    Calculate the workload by measuring the size of each db
+    Calculate the workload by measuring the cost of each db, in megapixels
 
-    Aim for small tasks occupying less than 10 minutes (depending on images size)
+    Inference time scales with pixel count, and datasets differ a lot in image
+    sizes (eg. HGR full-resolution hands versus small Pratheepan photos)
+
+    Aim for small tasks occupying less than 10 minutes (`max_task_megapixels`)
     or else big dataset could occupy a worker for a very long time,
     while other workers are sleeping.
 
     Also aim for a number of tasks that is multiple of the number of workers
     so that they can always run in parallel
 
-    Return also a dict containing each db with their size
+    Return also a dict containing each db with the cost of each of its images
     '''
     assert workers > 0, 'Number of workers is negative! Is it using the default of -1? Call determine_workers(workers)'
 
-    # Get total db size
-    db_sizes = {}
-    total_db_size = 0
+    # Get total db cost
+    db_costs = {}
     for m in models:
+        db = get_db_by_name(m)
         if use_only_test_set:
-            image_paths = get_db_by_name(m).get_test_paths()
+            image_paths = db.get_test_paths()
         else:
-            image_paths = get_db_by_name(m).get_all_paths()
-        db_size = len(image_paths)
-        db_sizes[m] = db_size
-        total_db_size = total_db_size + db_size
+            image_paths = db.get_all_paths()
+        db_costs[m] = get_megapixels(db, image_paths)
+    total_cost = sum(sum(costs) for costs in db_costs.values())
     
-    workload = total_db_size // workers
+    workload = total_cost / workers
     j = 2 # each worker does 2 tasks
-    while workload > 300: # Aim for small tasks occupying less than 10 minutes
-        workload = total_db_size // (workers *j)
+    while workload > max_task_megapixels: # Aim for small tasks occupying less than 10 minutes
+        workload = total_cost / (workers *j)
         j = j+1 # each worker does 3 tasks, etc..
 
-    return workload, db_sizes, total_db_size
+    # avoid zero division on empty datasets
+    return max(workload, 1e-6), db_costs, total_cost
 
-def generate_commands(cmd_single: str, target_size: int, target_tasks: int, workload: int,
-                model_name: str, target_name: str, bar_position: int) -> list:
+def partition_by_cost(costs: list, parts: int) -> list:
+    '''Split a list of costs into at most `parts` contiguous (start, end) slices of similar total cost'''
+    total = sum(costs)
+    slices = []
+    slice_start = 0
+    accumulated = 0
+    for i, cost in enumerate(costs):
+        accumulated += cost
+        if len(slices) < parts - 1 and accumulated >= total * (len(slices) + 1) / parts:
+            slices.append((slice_start, i + 1))
+            slice_start = i + 1
+    if slice_start < len(costs):
+        slices.append((slice_start, len(costs)))
+    return slices
+
+def generate_tasks(target_costs: list, target_tasks: int,
+                model_name: str, target_name: str) -> list:
     '''
-    Translate tasks regarding a given target dataset into `singlepredict.py` commands
+    Split the predictions on a given target dataset into tasks of similar cost
+
+    Each task is a dict with the model and target names, the slice of
+    target images (`from`, `to`), its cost in megapixels, and the progress bar position
 
     Arguments
     ---
-    cmd_single: `singlepredict.py` command to format with other arguments
-    target_size: size of target dataset in images
+    target_costs: megapixels of each image of the target dataset
     target_tasks: number of tasks assigned to target dataset
-    workload: the workload
     model_name: the model name
-    target_name: the target name
-    bar_position: where the `tqdm` progress bar appears on console
+    target_name: the target name, None on base predictions (on self)
     '''
 
     # Determine if it is a base prediction (on self), or a cross-dataset prediction
     if target_name is None:
         target_name = model_name
-        model_name = None
     
-    commands = []
+    tasks = []
+    for slice_start, slice_end in partition_by_cost(target_costs, target_tasks):
+        # note: end index is excluded in predictions
+        tasks.append({'model': model_name, 'target': target_name,
+                      'from': slice_start, 'to': slice_end, 'bar': 0,
+                      'cost': sum(target_costs[slice_start:slice_end])})
+    return tasks
+
+def order_tasks(tasks: list) -> list:
+    '''Sort tasks longest-first, so that big tasks do not start last, and assign progress bar positions'''
+    tasks = sorted(tasks, key=lambda t: t['cost'], reverse=True)
+    for bar_position, t in enumerate(tasks):
+        t['bar'] = bar_position
+    return tasks
+
+def generate_commands(tasks: list, output: str = '', threshold: float = default_threshold,
+                      shared_models: dict = None, model_files: dict = None) -> list:
+    '''
+    Translate tasks into `singlepredict.py` commands
 
-    slice_start = 0
-    for i in range(target_tasks):
-        # Current db finished, pass to the next one
-        if slice_start > target_size or slice_start == -1:
-            break
-
-        slice_end = slice_start + workload # note: end index is excluded in predictions
-
-        # The last worker finish the set
-        if i == target_tasks -1 or slice_end > target_size:
-            slice_end = -1
-        
-        # Format the command properly
-        # base prediction cmd_single only requires target_name
-        if model_name is None:
-            commands.append(cmd_single.format(target_name, slice_start, slice_end, bar_position))
-        # cross prediction cmd_single requires model_name and target_name
-        else:
-            commands.append(cmd_single.format(model_name, target_name, slice_start, slice_end, bar_position))
-        
-        # Update bar position
-        bar_position = bar_position + 1
-        # Update starting index
-        slice_start = slice_end
-    return commands, bar_position
-
-def log_debug(debug: bool, workers: int, workload: int, db_sizes: dict = None):
+    Models are given by dataset name, or by file if `model_files` are given
+    '''
+    output_arg = '' if output == '' else f' --output={shlex.quote(output)}'
+    cmd_single = cmd_root + '{model_arg} --predict={target} --from={from} --to={to} --bar={bar} --report'
+    cmd_single = cmd_single + output_arg + threshold_arg(threshold)
+
+    return [cmd_single.format(model_arg=model_arg(model_files, t['model']), **t)
+            + shared_arg(shared_models, t['model']) for t in tasks]
+
+def log_debug(debug: bool, workers: int, workload: float, db_tasks: dict = None):
     if debug:
         info(f'Workers  = {workers}')
-        info(f'Workload = {workload}')
+        info(f'Workload = {workload:.2f} megapixels')
 
-        if db_sizes is not None:
-            info(f'Assigned work:')
-            info(db_sizes)
+        if db_tasks is not None:
+            info(f'Assigned tasks:')
+            info(db_tasks)
 
-# Credit to https://stackoverflow.com/a/50560686
-def clear_console():
-    print("\033[H\033[J", end="")
+def run_command(cmd: str, progress_bar: tqdm, lock: threading.Lock) -> int:
+    '''
+    Run a single command and wait for it, forwarding its progress reports to `progress_bar`
 
-def run_commands(commands: list, workers: int, debug: bool):
+    Its other output, logs on stderr included, is written above the bar so as not to break it.
+    Return the command exit code
+    '''
+    args = shlex.split(cmd)
+    if args[0] == 'python': # same interpreter as the parent
+        args[0] = sys.executable
+
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) as process:
+        for line in process.stdout:
+            with lock:
+                if line.startswith(progress_prefix):
+                    progress_bar.update(int(line[len(progress_prefix):]))
+                else:
+                    progress_bar.write(line.rstrip())
+        return process.wait()
+
+def run_commands(commands: list, workers: int, debug: bool, total: int = None):
     '''
     Run the given commands list
 
     The program will automatically handle the executions even
-    if there are more commands than workers
+    if there are more commands than workers: a command starts as soon
+    as a worker slot frees up, in list order
 
-    It also tries to print the status of each alive worker via `tqdm`
+    Progress is shown by a single bar, fed by the commands reports.
+    `total` is the number of images to predict, if known
     '''
     if debug:
         info(f'Resulting commands: {len(commands)}')
         for cmd in commands:
             info(cmd)
 
-    procs_list = []
-    alive_procs = 1
-    # While there are still tasks running
-    while alive_procs > 0:
-        clear_console() # clear console or else progress bars are buggy
-
-        # Print tasks status
-        print(f'TASKS REMAINING: {len(commands)}')
-        print(f'\n\nWORKERS STATUS, ALIVE={alive_procs}')
-        
-        # If there is a free slot among workers
-        if len(commands) > 0 and alive_procs < workers:
-            # Pop one command from the list
-            cmd = commands.pop()
-
-            # Run a command
-            # without shell=True it does not work on Windows
-            # without stdin,stout,sterr to None, it is not async
-            process = subprocess.Popen(cmd.split(), shell=True, stdin=None, stdout=None, stderr=None)
-            procs_list.append(psutil.Process(process.pid))
-        # If the command list is empty it means the program is
-        # waiting for tasks to finish (cannot pop on empty list)
-        else:
-            time.sleep(1.5) # be lighter than a while true
-        
-        # Update tasks status
-        gone, alive = psutil.wait_procs(procs_list, timeout=3)
-        alive_procs = len(alive)
+    progress_bar = tqdm(total=total)
+    lock = threading.Lock()
+    # each thread waits for its child process, and then takes the next command
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_command, cmd, progress_bar, lock): cmd for cmd in commands}
+        for future in as_completed(futures):
+            exit_code = future.result()
+            if exit_code != 0:
+                with lock:
+                    error(f'Command failed with exit code {exit_code}: {futures[future]}')
+    progress_bar.close()
+
+def threshold_arg(threshold: float) -> str:
+    '''Return the threshold argument of single commands, empty if it is the default one'''
+    return '' if threshold == default_threshold else f' --threshold={threshold}'
+
+def model_arg(model_files: dict, model_name: str) -> str:
+    '''Return the model argument of single commands: the dataset name, or the model file if `model_files` are given'''
+    return f'--model={model_name}' if model_files is None else f'--model-file={shlex.quote(model_files[model_name])}'
+
+def share_models(model_files: dict, shared_models: dict) -> dict:
+    '''
+    Load each model once in the parent process and share it with workers
 
-def gen_base_cmds(models: list, workers: int, debug: bool = False, output: str = ''):
-    '''Return a list containing single commands needed to perform base dataset predictions'''
-    commands = []
-    output_arg = '' if output == '' else f' --output={output}'
-    cmd_single = cmd_root + '--model={} --from={} --to={} --bar={}' + output_arg
+    `model_files` contains each model name with its model file.
+    Fill `shared_models` one model at a time with each model name and the file
+    workers should load, so that the models already shared can be unshared
+    if sharing another one fails. Return `shared_models`
+    '''
+    for m, filename in model_files.items():
+        shared_models[m] = share_model(filename)
+    return shared_models
+
+def unshare_models(model_files: dict, shared_models: dict):
+    for m, shared in shared_models.items():
+        unshare_model(model_files[m], shared)
+
+def shared_arg(shared_models: dict, model_name: str) -> str:
+    '''Return the shared model argument of single commands, empty if models are not shared'''
+    return '' if shared_models is None else f' --shared-model={shlex.quote(shared_models[model_name])}'
+
+def gen_base_tasks(models: list, workers: int, debug: bool = False) -> list:
+    '''Return a list containing the tasks needed to perform base dataset predictions'''
+    tasks = []
 
     # Calculate workload and assign tasks
-    workload, db_sizes, total_db_size = calculate_workload(models, workers, use_only_test_set=True)
-    db_sizes = determine_tasks_per_db(db_sizes, workload, total_db_size, debug)
-    log_debug(debug, workers, workload, db_sizes)
+    workload, db_costs, total_cost = calculate_workload(models, workers, use_only_test_set=True)
+    db_tasks = determine_tasks_per_db(db_costs, workload)
+    log_debug(debug, workers, workload, db_tasks)
 
-    bar_position = 0
     for m in models:
-        # Assign work and concatenate the resulting commands
-        cmds_on_target, bar_position = generate_commands(cmd_single, db_sizes[m], db_sizes[m+'w'], workload, m, None, bar_position)
-        commands.extend(cmds_on_target)
-    return commands
+        # Assign work and concatenate the resulting tasks
+        tasks.extend(generate_tasks(db_costs[m], db_tasks[m], m, None))
+    return order_tasks(tasks)
 
-def gen_cross_cmds(models: list, workers: int, debug: bool = False, output: str = ''):
-    '''Return a list containing single commands needed to perform cross dataset predictions'''
-    commands = []
-    output_arg = '' if output == '' else f' --output={output}'
-    cmd_single = cmd_root + '--model={} --predict={} --from={} --to={} --bar={}' + output_arg
+def gen_cross_tasks(models: list, workers: int, debug: bool = False) -> list:
+    '''Return a list containing the tasks needed to perform cross dataset predictions'''
+    tasks = []
 
     # Calculate workload and assign tasks
 
     # on cross predictions, use all paths
-    workload, db_sizes, total_db_size = calculate_workload(models, workers, use_only_test_set=False)
-    db_sizes = determine_tasks_per_db(db_sizes, workload, total_db_size, debug)
-    log_debug(debug, workers, workload, db_sizes)
+    workload, db_costs, total_cost = calculate_workload(models, workers, use_only_test_set=False)
+    db_tasks = determine_tasks_per_db(db_costs, workload)
+    log_debug(debug, workers, workload, db_tasks)
 
-    bar_position = 0
     for m in models: # model: train dataset
         for p in models: # prediction: target dataset
             # In cross dataset do not predict on self
             if m == p:
                 continue
-            # Assign work and concatenate the resulting commands
-            cmds_on_target, bar_position = generate_commands(cmd_single, db_sizes[m], db_sizes[m+'w'], workload, m, p, bar_position)
-            commands.extend(cmds_on_target)
-    return commands
+            # Assign work and concatenate the resulting tasks
+            # the target dataset determines how much work there is
+            tasks.extend(generate_tasks(db_costs[p], db_tasks[p], m, p))
+    return order_tasks(tasks)
+
+def gen_base_cmds(models: list, workers: int, debug: bool = False, output: str = '',
+                  threshold: float = default_threshold, shared_models: dict = None):
+    '''Return a list containing single commands needed to perform base dataset predictions'''
+    return generate_commands(gen_base_tasks(models, workers, debug), output, threshold, shared_models)
+
+def gen_cross_cmds(models: list, workers: int, debug: bool = False, output: str = '',
+                   threshold: float = default_threshold, shared_models: dict = None):
+    '''Return a list containing single commands needed to perform cross dataset predictions'''
+    return generate_commands(gen_cross_tasks(models, workers, debug), output, threshold, shared_models)
+
+def run_engine(engine: str, tasks: list, models: list, workers: int, debug: bool,
+               output: str = '', threshold: float = default_threshold, shared: bool = True,
+               scheduler: str = 'dynamic', model_files: dict = None):
+    '''
+    Run the given tasks with the chosen engine
+
+    `models` are dataset names, whose models are predicted with,
+    unless `model_files` gives the file of each model name (eg. merged models)
+
+    'pool': an in-process worker pool which loads models once per worker.
+    With the 'dynamic' scheduler, the tasks only tell which predictions to perform
+    and workers pull chunks of images while running
+    'subprocess': one `python main.py single` process per task
+    '''
+    shared_models = {} if shared else None
+    # commands of dataset models keep naming them by dataset
+    commands_files = model_files
+    if model_files is None:
+        model_files = {m: get_model_filename(get_db_by_name(m)) for m in models}
+
+    try:
+        if shared:
+            share_models(model_files, shared_models)
+        if engine == 'pool':
+            run_tasks(tasks, model_files if shared_models is None else shared_models, workers,
+                      output=output, threshold=threshold, scheduler=scheduler)
+        else:
+            total = sum(t['to'] - t['from'] for t in tasks)
+            run_commands(generate_commands(tasks, output, threshold, shared_models, commands_files),
+                         workers, debug, total=total)
+    finally:
+        if shared:
+            unshare_models(model_files, shared_models)
 
 # Main command which groups the subcommands: single, batch
 @click.group()
@@ -256,15 +311,27 @@ def cli_multipredict():
 
 @cli_multipredict.command(name='singlem', short_help='Multiprocessing on single prediction')
 @click.option('--model', '-m',
-              type=click.Choice(skin_databases_names(get_models()), case_sensitive=False), required=True)
+              type=click.Choice(skin_databases_names(get_models()), case_sensitive=False))
+@click.option('--model-file', 'model_file', type=click.Path(exists=True, dir_okay=False),
+              help = 'Model file to predict with instead of the model of a dataset (eg. a merged model)')
 @click.option('--predict', '-p', 'predict_',
               type=click.Choice(skin_databases_names(get_datasets()), case_sensitive=False))
 @click.option('--workers', '-w', type=int, default=-1, help = 'Number of processes, default is auto')
 @click.option('--debug/--no-debug', '-d', 'debug', default=False, help = 'Print more info')
-def single_multi(model, predict_, workers, debug):
+@click.option('--threshold', type=float, default=default_threshold, show_default=True,
+              help = 'Skin probability threshold')
+@click.option('--shared/--no-shared', 'shared', default=True, show_default=True,
+              help = 'Load the model once and share it with workers')
+@click.option('--engine', '-e', type=click.Choice(engines), default='pool', show_default=True,
+              help = 'Run tasks in a pool of worker processes, or one subprocess each')
+@click.option('--scheduler', '-s', type=click.Choice(schedulers), default='dynamic', show_default=True,
+              help = 'Pool engine: split work into chunks while running, or use fixed slices')
+def single_multi(model, model_file, predict_, workers, debug, threshold, shared, engine, scheduler):
     # prediction on self
     if predict_ is None:
+        assert model_file is None, 'Missing option --predict: a model file has no dataset'
         predict_ = model
+    model, filename = resolve_model(model, model_file)
 
     models = [predict_]
     # Check if the number of workers need to be automatically determined
@@ -273,35 +340,18 @@ def single_multi(model, predict_, workers, debug):
     # Get images to predict
     if predict_ == model:
         # on same dataset, use test paths
-        workload, db_sizes, total_db_size = calculate_workload(models, workers, use_only_test_set=True)
+        workload, db_costs, total_cost = calculate_workload(models, workers, use_only_test_set=True)
     else:
         # on cross datasets, use all paths
-        workload, db_sizes, total_db_size = calculate_workload(models, workers, use_only_test_set=False)
+        workload, db_costs, total_cost = calculate_workload(models, workers, use_only_test_set=False)
 
     # Calculate workload and assign tasks
-    db_sizes = determine_tasks_per_db(db_sizes, workload, total_db_size, debug)
-    task_number = db_sizes[predict_ + 'w']
-    log_debug(debug, workers, workload, db_sizes)
+    db_tasks = determine_tasks_per_db(db_costs, workload)
+    log_debug(debug, workers, workload, db_tasks)
 
-    commands = []
-    cmd_single = cmd_root + '--model={} --predict={} --from={} --to={} --bar={}'
-
-    # Translate tasks to commands
-    slice_start = 0
-    for i in range(task_number):
-        slice_end = slice_start + workload # note: end index is excluded in predictions
-
-        # The last worker finish the set
-        if i == task_number -1 or slice_end > total_db_size:
-            slice_end = -1
-        
-        commands.append(cmd_single.format(model, predict_, slice_start, slice_end, i))
-
-        # Update starting index
-        slice_start = slice_end
-    
-    # start processes and do not wait
-    run_commands(commands, workers, debug)
+    tasks = order_tasks(generate_tasks(db_costs[predict_], db_tasks[predict_], model, predict_))
+    run_engine(engine, tasks, [model], workers, debug, threshold=threshold, shared=shared, scheduler=scheduler,
+               model_files=None if model_file is None else {model: filename})
 
 @cli_multipredict.command(name='batchm', short_help='Multiprocessing on batch predictions (eg. base, cross)')
 @click.option('--mode', '-m', type=click.Choice(['base', 'cross', 'all']), required=True)
@@ -313,20 +363,28 @@ def single_multi(model, predict_, workers, debug):
 @click.option('--output', '-o', default = '',
               type=click.Path(exists=False),
               help = 'Define the directory in which to save predictions')
-def batch_multi(mode, target, workers, debug, output):
+@click.option('--threshold', type=float, default=default_threshold, show_default=True,
+              help = 'Skin probability threshold')
+@click.option('--shared/--no-shared', 'shared', default=True, show_default=True,
+              help = 'Load each model once and share it with workers')
+@click.option('--engine', '-e', type=click.Choice(engines), default='pool', show_default=True,
+              help = 'Run tasks in a pool of worker processes, or one subprocess each')
+@click.option('--scheduler', '-s', type=click.Choice(schedulers), default='dynamic', show_default=True,
+              help = 'Pool engine: split work into chunks while running, or use fixed slices')
+def batch_multi(mode, target, workers, debug, output, threshold, shared, engine, scheduler):
     models = target
     assert len(models) > 1, 'Select at least 2 datasets!'
     # Check if the number of workers need to be automatically determined
     workers = determine_workers(workers)
 
-    # Determine commands to run
+    # Determine tasks to run
     if mode == 'base':
-        commands = gen_base_cmds(models, workers, debug=debug, output=output)
+        tasks = gen_base_tasks(models, workers, debug=debug)
     elif mode == 'cross':
-        commands = gen_cross_cmds(models, workers, debug=debug, output=output)
+        tasks = gen_cross_tasks(models, workers, debug=debug)
     else: # 'all' does either base+cross or skinbase+skincross, depending on --skintone
-        commands = gen_base_cmds(models, workers, debug=debug, output=output)
-        commands.extend(gen_cross_cmds(models, workers, debug=debug, output=output))
+        tasks = gen_base_tasks(models, workers, debug=debug)
+        tasks = order_tasks(tasks + gen_cross_tasks(models, workers, debug=debug))
 
-    # start processes and do not wait
-    run_commands(commands, workers, debug)
+    run_engine(engine, tasks, models, workers, debug, output=output, threshold=threshold,
+               shared=shared, scheduler=scheduler)
@@ -1,41 +1,60 @@
 import os
 
 import click
-import pandas as pd
 from predict import (base_preds, cross_preds, get_timestamp, make_predictions,
-                     pred_dir, predict, pred_name)
+                     p_formats, pred_dir, predict, single_pred_dir)
 from utils.db_utils import *
 from utils.ECU import ECU, ECU_bench
 from utils.logmanager import *
-from utils.metrics_utils import read_performance
+from utils.metrics_utils import probability_ext, read_performance
+from utils.skin_model import default_threshold, open_model
 
 
 @click.group()
 def cli_predict():
     pass
 
+def check_evaluate(evaluate: bool, p_format: str):
+    '''Predictions measured in memory are binary masks: probability maps are measured once saved'''
+    if evaluate and p_format != 'mask':
+        raise click.UsageError('--evaluate measures binary masks: save probability maps with '
+                               f'--prediction-format {p_format} and measure them with `eval` instead')
+
 @cli_predict.command(short_help='N-on-M datasets predictions')
 @click.option('--mode', '-m', type=click.Choice(['base', 'cross', 'all']), required=True)
 @click.option('--dataset' , '-d',  multiple=True,
               type=click.Choice(skin_databases_names(get_models_with_datasets()), case_sensitive=False), required = True,
               help = 'Datasets to use (eg. -d ECU -d HGR_small -d medium)')
-def batch(mode, dataset):
+@click.option('--threshold', type=float, default=default_threshold, show_default=True,
+              help = 'Skin probability threshold')
+@click.option('--threads', type=click.IntRange(1), default=1, show_default=True,
+              help = 'Threads sharing the inference on each image, by row blocks')
+@click.option('--prediction-format', 'p_format', type=click.Choice(p_formats), default='mask', show_default=True,
+              help = 'Save binary masks, or skin probability maps to measure at any threshold: float32 npy, '
+                     'or 8 or 16-bit PNG (approximate: rounded to the nearest 1/255 or 1/65535)')
+@click.option('--evaluate', is_flag=True,
+              help = 'Measure binary masks in memory instead of saving predictions, dumping metrics as `eval --dump`')
+def batch(mode, dataset, threshold, threads, p_format, evaluate):
     '''
     BATCH: N-on-M datasets predictions
     N are models, M are datasets
     '''
+    check_evaluate(evaluate, p_format)
     timestr = get_timestamp()
 
-    models = dataset
-    models = skin_databases_names(models)
+    models = [get_db_by_name(d) for d in dataset]
 
     if mode == 'base':
-        base_preds(timestr, models)
+        base_preds(timestr, models, threshold=threshold, threads=threads, p_format=p_format,
+                   evaluate=evaluate)
     elif mode == 'cross':
-        cross_preds(timestr, models)
+        cross_preds(timestr, models, threshold=threshold, threads=threads, p_format=p_format,
+                    evaluate=evaluate)
     else: # 'all' does either base+cross or skinbase+skincross, depending on --skintone
-        base_preds(timestr, models)
-        cross_preds(timestr, models)
+        base_preds(timestr, models, threshold=threshold, threads=threads, p_format=p_format,
+                   evaluate=evaluate)
+        cross_preds(timestr, models, threshold=threshold, threads=threads, p_format=p_format,
+                    evaluate=evaluate)
 
 @cli_predict.command(short_help='Measure inference time')
 @click.option('--size', '-s', type=int, default = 15, show_default=True,
@@ -64,7 +83,9 @@ def bench(size, observations):
 
 @cli_predict.command(short_help='1-on-1 datasets prediction')
 @click.option('--model', '-m',
-              type=click.Choice(skin_databases_names(get_models()), case_sensitive=False), required=True)
+              type=click.Choice(skin_databases_names(get_models()), case_sensitive=False))
+@click.option('--model-file', 'model_file', type=click.Path(exists=True, dir_okay=False),
+              help = 'Model file to predict with instead of the model of a dataset (eg. a merged model)')
 @click.option('--predict', '-p', 'predict_',
               type=click.Choice(skin_databases_names(get_datasets()), case_sensitive=False))
 @click.option('--from', '-f', 'from_', type=int, default = 0, help = 'Slice start')
@@ -73,11 +94,31 @@ def bench(size, observations):
 @click.option('--output', '-o', default = '',
               type=click.Path(exists=False),
               help = 'Define the directory in which to save predictions')
-def single(model, predict_, from_, to, bar, output):
+@click.option('--threshold', type=float, default=default_threshold, show_default=True,
+              help = 'Skin probability threshold')
+@click.option('--shared-model', 'shared_model', default = '',
+              type=click.Path(exists=False),
+              help = 'Model file shared by the parent process (for multiprocessing)')
+@click.option('--report/--no-report', 'report', default=False,
+              help = 'Report progress on stdout to the parent process (for multiprocessing)')
+@click.option('--sparse', is_flag=True,
+              help = 'Query the model by binary searches instead of a dense LUT, to save memory')
+@click.option('--threads', type=click.IntRange(1), default=1, show_default=True,
+              help = 'Threads sharing the inference on each image, by row blocks')
+@click.option('--prediction-format', 'p_format', type=click.Choice(p_formats), default='mask', show_default=True,
+              help = 'Save binary masks, or skin probability maps to measure at any threshold: float32 npy, '
+                     'or 8 or 16-bit PNG (approximate: rounded to the nearest 1/255 or 1/65535)')
+@click.option('--evaluate', is_flag=True,
+              help = 'Measure binary masks in memory instead of saving predictions, dumping metrics as `eval --dump`')
+def single(model, model_file, predict_, from_, to, bar, output, threshold, shared_model, report, sparse,
+           threads, p_format, evaluate):
     '''SINGLE: 1-on-1 datasets prediction. Can be on self too'''
+    check_evaluate(evaluate, p_format)
     # prediction on self
     if predict_ is None:
+        assert model_file is None, 'Missing option --predict: a model file has no dataset'
         predict_ = model
+    model, model_name = resolve_model(model, model_file)
     
     target_dataset = get_db_by_name(predict_)
     if predict_ == model:
@@ -91,23 +132,33 @@ def single(model, predict_, from_, to, bar, output):
 
     assert os.path.isdir(target_dataset.dir), 'Dataset has no directory: ' + target_dataset.name
     # Make predictions
-    model_name = get_model_filename(get_db_by_name(model))
-    if output == '':
-        out_dir = pred_dir(None, None, name = f'{model}_on_{predict_}')
-    else:
-        name = pred_name(f'{model}_on_{predict_}')
-        out_dir = os.path.join(output, name)
-        os.makedirs(output, exist_ok=True)
-    make_predictions(image_paths[from_:to], model_name, out_dir, pbar_position=bar)
+    if shared_model: # avoid parsing the model in each process
+        model_name = shared_model
+    if sparse:
+        model_name = open_model(model_name, threshold, sparse=True)
+    out_dir = single_pred_dir(model, predict_, output)
+    make_predictions(image_paths[from_:to], model_name, out_dir, pbar_position=bar, threshold=threshold,
+                     report=report, threads=threads, p_format=p_format, evaluate=evaluate)
 
 @cli_predict.command(
     short_help='Single image prediction')
 @click.option('--model', '-m',
-              type=click.Choice(skin_databases_names(get_models()), case_sensitive=False), required=True)
+              type=click.Choice(skin_databases_names(get_models()), case_sensitive=False))
+@click.option('--model-file', 'model_file', type=click.Path(exists=True, dir_okay=False),
+              help = 'Model file to predict with instead of the model of a dataset (eg. a merged model)')
 @click.option('--path', '-p',
               type=click.Path(exists=True), required=True,
               help = 'Path to the image to predict on')
-def image(model, path):
+@click.option('--threshold', type=float, default=default_threshold, show_default=True,
+              help = 'Skin probability threshold')
+@click.option('--sparse', is_flag=True,
+              help = 'Query the model by binary searches instead of a dense LUT, to save memory')
+@click.option('--threads', type=click.IntRange(1), default=1, show_default=True,
+              help = 'Threads sharing the inference on each image, by row blocks')
+@click.option('--prediction-format', 'p_format', type=click.Choice(p_formats), default='mask', show_default=True,
+              help = 'Save binary masks, or skin probability maps to measure at any threshold: float32 npy, '
+                     'or 8 or 16-bit PNG (approximate: rounded to the nearest 1/255 or 1/65535)')
+def image(model, model_file, path, threshold, sparse, threads, p_format):
     '''
     IMAGE: 1 model on 1 image prediction.
     Image may not have a grountruth.
@@ -118,11 +169,11 @@ def image(model, path):
 
     im_abspath = os.path.abspath(path)
     im_dir = os.path.dirname(path)
-    p_out = os.path.join(im_dir, ori_filename + '_p.png')
+    p_ext = probability_ext if p_format == 'npy' else '.png'
+    p_out = os.path.join(im_dir, ori_filename + '_p' + p_ext)
 
     assert os.path.isfile(path), 'Image file not existing: ' + path
     # Make predictions
-    model_name = get_model_filename(get_db_by_name(model))
-    info("Reading CSV...")
-    probability = pd.read_csv(model_name) # getting the rows from csv
-    predict(probability, im_abspath, None, p_out)
+    _, model_name = resolve_model(model, model_file)
+    predict(open_model(model_name, threshold, sparse=sparse), im_abspath, None, p_out, threads=threads,
+            p_format=p_format)
@@ -1,18 +1,89 @@
+import json
+import os
+
 import click
+from crossval import cross_validate
 from train import *
+from utils.cost_utils import determine_workers
 from utils.db_utils import (get_datasets, get_db_by_name, get_model_filename,
-                            skin_databases_names)
+                            get_trainable, model_formats, skin_databases_names)
+from utils.metrics_utils import dump_dir
+from utils.skin_model import default_threshold, model_layout
 
 
 @click.group()
 def cli_training():
     pass
 
-@cli_training.command(short_help='Generate the model CSV file from a given training dataset')
+@cli_training.command(short_help='Train the model of a dataset or of all of them (CSV, npy or npz), optionally on sampled pixels')
 @click.option('--dataset', '-d', type=click.Choice(skin_databases_names(get_datasets()),
-                case_sensitive=False), required=True)
-def train(dataset):
+                case_sensitive=False))
+@click.option('--all', '-a', 'all_', is_flag=True,
+              help = 'Train every dataset having splits in a single pass, reading shared images once')
+@click.option('--engine', '-e', type=click.Choice(engines), default='numpy', show_default=True,
+              help = 'Histogram accumulation engine')
+@click.option('--format', '-f', 'format_', type=click.Choice(model_formats), default='csv', show_default=True,
+              help = 'Model file format: native LUT (npy), sparse counts (npz) or CSV')
+@click.option('--workers', '-w', type=int, default=1, show_default=True,
+              help = 'Training processes (numpy engine). -1 to use the number of physical cores')
+@click.option('--update', '-u', is_flag=True,
+              help = 'Only count images not counted yet: resume an interrupted training, or add new images')
+@click.option('--bits', '-b', type=click.IntRange(1, 8), default=8, show_default=True,
+              help = 'Bits per colour channel: coarser bins give smaller LUTs (npy and npz formats)')
+@click.option('--colour-space', '-c', 'space', type=click.Choice(list(colour_spaces)), default=default_space,
+              show_default=True,
+              help = 'Colour space of the model (npy and npz formats). cbcr, hs and rg are 2D chrominance-only')
+@click.option('--sample-rate', type=click.FloatRange(0, 1, min_open=True), default=1.0, show_default=True,
+              help = 'Fraction of the pixels of each image to count, for fast approximate trainings')
+@click.option('--max-pixels-per-image', 'max_pixels', type=click.IntRange(1), default=None,
+              help = 'Count at most this many pixels of each image')
+@click.option('--sampling', type=click.Choice(samplings), default='stride', show_default=True,
+              help = 'Count evenly spaced pixels, or a seeded random subset')
+@click.option('--seed', type=int, default=0, show_default=True, help = 'Seed of random sampling')
+@click.option('--reference', '-r', type=click.Path(exists=True, dir_okay=False), default=None,
+              help = 'Model trained on every pixel, with the same bits and colour space: '
+                     'log the deviation of the sampled model from it')
+def train(dataset, all_, engine, format_, workers, update, bits, space, sample_rate, max_pixels,
+          sampling, seed, reference):
+    sampler = pixel_sampler(sample_rate, max_pixels, sampling, seed)
+    if all_:
+        assert engine == 'numpy' and workers == 1 and not update, \
+            'Training all datasets runs the numpy engine in a single process, without updates'
+        assert sampler.is_full() and reference is None, 'Training all datasets counts every pixel'
+        trainings = [(db.get_train_paths(), get_model_filename(db, format_), db.name)
+                     for db in get_trainable()]
+        do_training_all(trainings, bits=bits, space=space)
+        return
+
+    assert dataset is not None, 'Missing option --dataset (or --all)'
+    if reference is not None and not sampler.is_full() and model_layout(reference) != (bits, space):
+        raise click.UsageError(reference_mismatch(reference, bits, space))
     db = get_db_by_name(dataset)
-    out = get_model_filename(db)
+    out = get_model_filename(db, format_)
     image_paths = db.get_train_paths()
-    do_training(image_paths, out)
+    do_training(image_paths, out, engine=engine, dataset=db.name, workers=determine_workers(workers),
+                update=update, bits=bits, space=space, sampler=sampler, reference=reference)
+
+@cli_training.command(short_help='K-fold cross-validation of a dataset, without retraining each fold')
+@click.option('--dataset', '-d', type=click.Choice(skin_databases_names(get_datasets()),
+                case_sensitive=False), required=True)
+@click.option('--folds', '-k', type=click.IntRange(2), default=10, show_default=True,
+              help = 'Number of folds the whole dataset is split into')
+@click.option('--seed', '-s', type=int, default=None,
+              help = 'Seed of the shuffle before splitting, for reproducible folds')
+@click.option('--bits', '-b', type=click.IntRange(1, 8), default=8, show_default=True,
+              help = 'Bits per colour channel of the fold models')
+@click.option('--colour-space', '-c', 'space', type=click.Choice(list(colour_spaces)), default=default_space,
+              show_default=True, help = 'Colour space of the fold models')
+@click.option('--threshold', type=float, default=default_threshold, show_default=True,
+              help = 'Skin probability threshold of the fold models')
+@click.option('--dump/--no-dump', default=False, help = 'Whether to dump results to a file')
+def crossval(dataset, folds, seed, bits, space, threshold, dump):
+    db = get_db_by_name(dataset)
+    res = cross_validate(db.get_all_paths(), k=folds, seed=seed, bits=bits, space=space,
+                         threshold=threshold, desc=db.name)
+
+    if dump:
+        os.makedirs(dump_dir, exist_ok=True)
+        with open(os.path.join(dump_dir, f'crossval_{db.name}_{folds}.json'), 'w') as f:
+            json.dump(res, f, sort_keys = True, indent = 4)
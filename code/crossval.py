@@ -0,0 +1,131 @@
+import os
+from random import Random
+from statistics import mean, pstdev
+
+import numpy as np
+from tqdm import tqdm
+
+from metrics import eval_metrics
+from train import (add_image_counts, calc_probability, image_counts,
+                   max_counts, peak_memory, read_image_array)
+from utils.logmanager import *
+from utils.metrics_utils import (calc_mean_metrics, image_metrics,
+                                 load_groundtruth)
+from utils.skin_model import (colour_spaces, default_bits, default_space,
+                              default_threshold, lut_length, skin_model,
+                              sparse_counts)
+
+# K-fold cross-validation
+#   1. counting pass: each image is decoded once, and its colour counts are added
+#      to the histograms of its fold. Fold histograms are kept sparse, their sum dense
+#   2. inference pass: the model of fold k is the sum minus the counts of fold k,
+#      so no model is trained from scratch. Each image is decoded once more to be
+#      predicted by the model which has not seen it
+
+
+def make_folds(image_paths: list, k: int, seed: int = None) -> list:
+    '''Shuffle the (image, grountruth) paths with `seed`, and deal them into `k` folds'''
+    assert 2 <= k <= len(image_paths), critical(f'Cannot split {len(image_paths)} images into {k} folds')
+    image_paths = list(image_paths)
+    Random(seed).shuffle(image_paths)
+    return [image_paths[f::k] for f in range(k)]
+
+def count_folds(folds: list, bits: int = default_bits, space: str = default_space) -> tuple:
+    '''
+    Return (fold counts, skin, non_skin)
+
+    Fold counts are the sparse histograms of each fold as (keys, skin, non_skin),
+    `skin` and `non_skin` are the flat histograms of all the folds
+    '''
+    size = lut_length(bits, space)
+    skin_total = np.zeros(size, dtype=np.uint64)
+    non_skin_total = np.zeros(size, dtype=np.uint64)
+    fold_counts = []
+
+    for f, image_paths in enumerate(folds):
+        info(f'Counting fold {f + 1}/{len(folds)}...')
+        # fold histograms can be uint32 as long as they count less pixels than its maximum
+        pixels = 0
+        skin = np.zeros(size, dtype=np.uint32)
+        non_skin = np.zeros(size, dtype=np.uint32)
+        for i in tqdm(image_paths):
+            im = read_image_array(os.path.abspath(i[0]))
+            y = read_image_array(os.path.abspath(i[1]))
+            pixels += im.shape[0] * im.shape[1]
+            if pixels > max_counts and skin.dtype != np.uint64:
+                skin = skin.astype(np.uint64)
+                non_skin = non_skin.astype(np.uint64)
+            add_image_counts(skin, non_skin, image_counts(im, y, bits, space))
+
+        skin_total += skin
+        non_skin_total += non_skin
+        fold_counts.append(sparse_counts(skin, non_skin))
+    return fold_counts, skin_total, non_skin_total
+
+def fold_model(fold: tuple, skin, non_skin, space: str = default_space,
+               threshold: float = default_threshold) -> skin_model:
+    '''Return the model trained on every fold but `fold`, by taking its counts out of the totals'''
+    keys, fold_skin, fold_non_skin = fold
+    # subtract in place and add back, instead of copying the totals
+    skin[keys] -= fold_skin
+    non_skin[keys] -= fold_non_skin
+    probability = calc_probability(skin, non_skin, dtype=np.float32)
+    skin[keys] += fold_skin
+    non_skin[keys] += fold_non_skin
+    return skin_model(probability, {'size': probability.size, 'colour_space': space}, threshold)
+
+def evaluate_fold(model: skin_model, image_paths: list, metric_fns: list) -> list:
+    '''
+    Predict the given images and return their metrics, as `calc_metrics` does
+
+    Images are compared with the groundtruth as `measure eval` loads it (see `load_groundtruth`)
+    '''
+    singles = []
+    for i in tqdm(image_paths):
+        im = read_image_array(os.path.abspath(i[0]))
+        y_true = load_groundtruth(os.path.abspath(i[1]))
+        y_pred = model.is_skin(model.index(im)).reshape(im.shape[:2])
+        idata = {'y': i[1], 'x': i[0]}
+        idata.update(image_metrics(y_true, y_pred, metric_fns))
+        singles.append(idata)
+    return singles
+
+def summarize_folds(averages: list, metric_fns: list) -> dict:
+    '''Return the mean and standard deviation across folds of each fold average metric'''
+    res = {}
+    for metric_fn in metric_fns:
+        f_name = metric_fn.__name__
+        # averages are strings as 'mean ± std' (only 'mean' for medium-average metrics)
+        f_data = [float(a[f_name].split(' ')[0]) for a in averages]
+        res[f_name] = '{:.4f} ± {:.2f}'.format(mean(f_data), pstdev(f_data))
+    return res
+
+def cross_validate(image_paths: list, k: int = 10, seed: int = None, bits: int = default_bits,
+                   space: str = default_space, threshold: float = default_threshold,
+                   metric_fns: list = eval_metrics, desc: str = 'crossval') -> dict:
+    '''
+    Run a `k`-fold cross-validation over the given (image, grountruth) paths
+
+    Every image is read twice: once to be counted, once to be predicted
+    by the model of the folds not including it.
+    Return the averages of each fold and their summary across folds
+    '''
+    assert space in colour_spaces, 'Invalid colour space: ' + space
+    folds = make_folds(image_paths, k, seed)
+    fold_counts, skin, non_skin = count_folds(folds, bits, space)
+
+    averages = []
+    for f, image_paths in enumerate(folds):
+        info(f'Evaluating fold {f + 1}/{len(folds)}...')
+        model = fold_model(fold_counts[f], skin, non_skin, space, threshold)
+        singles = evaluate_fold(model, image_paths, metric_fns)
+        averages.append(calc_mean_metrics(singles, metric_fns, desc=f'{desc} fold {f + 1}/{k}',
+                                          method='crossval'))
+
+    summary = summarize_folds(averages, metric_fns)
+    info(f'{desc} across {k} folds')
+    for key, value in sorted(summary.items()):
+        info(f'{key}: {value}')
+    info(f'Peak memory: {peak_memory():.0f} MB')
+    return {'folds': averages, 'summary': summary, 'k': k, 'seed': seed,
+            'bits': bits, 'colour_space': space, 'threshold': threshold}
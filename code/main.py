@@ -2,6 +2,7 @@ import click
 
 from cli.manage import cli_manage
 from cli.measure import cli_measure
+from cli.models import cli_models
 from cli.multipredict import cli_multipredict
 from cli.singlepredict import cli_predict
 from cli.training import cli_training
@@ -9,7 +10,7 @@ from cli.thesis import cli_thesis
 
 # Collect command groups
 cli = click.CommandCollection(sources=[cli_multipredict, cli_predict,
-        cli_manage, cli_measure, cli_training, cli_thesis])
+        cli_manage, cli_measure, cli_training, cli_thesis, cli_models])
 
 if __name__ == "__main__":
     # Setup Command Line Interface
@@ -203,3 +203,6 @@ def mcc(cs):
     den = math.sqrt((cs['tp'] + cs['fp']) * (cs['tp'] + cs['fn']) * (cs['tn'] + cs['fp']) * (cs['tn'] + cs['fn']))
 
     return num / (den + smooth)
+
+# Metrics computed by `measure eval`
+eval_metrics = [f1_medium, f1, f2, iou, iou_logical, dprs_medium, dprs, mcc, recall, precision, specificity]
@@ -0,0 +1,216 @@
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from math import ceil
+
+from tqdm import tqdm
+
+from predict import predict_targets, single_pred_dir
+from utils.db_utils import get_db_by_name
+from utils.hash_utils import hash_dir
+from utils.logmanager import *
+from utils.skin_model import default_threshold, models_cache
+
+# In-process worker pool for predictions
+# Workers are started once, load their models once in the initializer,
+# and then receive slices of image paths instead of command strings.
+# Work is (model names, image paths, out dirs): every model predicts on the same
+# images, which workers decode once
+
+
+# Models loaded by the current worker process, by model name
+worker_models = {}
+
+# Dynamic scheduler: size of the first chunks, when image latency is still unknown
+initial_chunk = 4
+# Dynamic scheduler: aim for chunks lasting this many seconds
+chunk_seconds = 2.0
+# Dynamic scheduler: weight of the last measurement in the latency moving average
+latency_smoothing = 0.3
+
+def init_worker(model_files: dict, threshold: float):
+    '''Pool initializer: load every model the worker may be asked to use'''
+    for name, filename in model_files.items():
+        worker_models[name] = models_cache.get(filename, threshold)
+
+def run_work(work: tuple) -> tuple:
+    '''Predict on a slice of images, return the number of images processed and the time taken'''
+    model_names, image_paths, out_dirs = work
+    t_start = time.time()
+    # workers are processes already: no need for threads pipelining each of them
+    predict_targets([worker_models[m] for m in model_names], image_paths, out_dirs, pipeline=False)
+    return len(image_paths), time.time() - t_start
+
+def get_target_paths(model_name: str, target_name: str) -> list:
+    '''Return the images to predict on: test set on self, whole dataset on cross predictions'''
+    target = get_db_by_name(target_name)
+    if model_name == target_name:
+        return target.get_test_paths()
+    return target.get_all_paths()
+
+def prepare_work(tasks: list, output: str = '') -> list:
+    '''
+    Translate tasks into work for the pool: ((model name,), image paths, (out dir,))
+
+    Dataset CSV files are read once per (model, target) pair
+    '''
+    target_paths = {}
+    work = []
+    for t in tasks:
+        key = (t['model'], t['target'])
+        if key not in target_paths:
+            target_paths[key] = get_target_paths(*key)
+        image_paths = target_paths[key]
+
+        out_dir = single_pred_dir(t['model'], t['target'], output)
+        work.append(((t['model'],), image_paths[t['from']:t['to']], (out_dir,)))
+    return work
+
+def prepare_jobs(tasks: list, output: str = '') -> list:
+    '''
+    Merge tasks into jobs covering the whole target: one per prediction on self,
+    one per target of cross predictions, so that every model predicting on the same
+    images shares their decoding
+
+    Jobs are lists: [model names, image paths, out dirs, index of the next image to schedule]
+    '''
+    # target images by job key: the model itself on self, all the models on cross predictions
+    groups = {}
+    for t in tasks:
+        key = (t['model'] if t['model'] == t['target'] else None, t['target'])
+        models = groups.setdefault(key, [])
+        if t['model'] not in models:
+            models.append(t['model'])
+    return [[tuple(models), get_target_paths(models[0], p), tuple(single_pred_dir(m, p, output) for m in models), 0]
+            for (_, p), models in groups.items()]
+
+class dynamic_scheduler(object):
+    '''
+    Hand out small chunks of images to workers as soon as they become idle
+
+    Chunk size adapts to the measured latency of each target dataset, aiming
+    for chunks of `chunk_seconds`, and it shrinks as the remaining work runs out
+    (guided scheduling) so that the long tail gets split among all workers
+    '''
+    def __init__(self, jobs: list, workers: int):
+        self.jobs = jobs
+        self.workers = workers
+        # seconds per image, by out dirs
+        self.latency = {}
+        # chunks handed out, by out dirs
+        self.issued = {}
+
+    def remaining(self, job: list) -> int:
+        return len(job[1]) - job[3]
+
+    def total_remaining(self) -> int:
+        return sum(self.remaining(j) for j in self.jobs)
+
+    def estimated_time(self, job: list) -> float:
+        return self.remaining(job) * self.latency[job[2]]
+
+    def next_work(self):
+        '''Return the next chunk as work for the pool, None if everything is scheduled'''
+        pending = [j for j in self.jobs if self.remaining(j) > 0]
+        if not pending:
+            return None
+        unmeasured = [j for j in pending if j[2] not in self.latency]
+        if unmeasured:
+            # unmeasured jobs go first, in turn, to learn the latency of each of them early
+            job = min(unmeasured, key=lambda j: self.issued.get(j[2], 0))
+        else:
+            # longest remaining job first
+            job = max(pending, key=self.estimated_time)
+
+        if job[2] in self.latency:
+            size = round(chunk_seconds / max(self.latency[job[2]], 1e-6))
+        else:
+            size = initial_chunk
+        # split late: never take more than a share of what is left for each worker
+        size = min(size, ceil(self.total_remaining() / (2 * self.workers)))
+        size = max(1, min(size, self.remaining(job)))
+
+        start = job[3]
+        job[3] = start + size
+        self.issued[job[2]] = self.issued.get(job[2], 0) + 1
+        return (job[0], job[1][start:start + size], job[2])
+
+    def update(self, out_dirs: tuple, images: int, elapsed: float):
+        '''Update the latency moving average of a job with a finished chunk'''
+        if images == 0:
+            return
+        measured = elapsed / images
+        if out_dirs in self.latency:
+            measured = latency_smoothing * measured + (1 - latency_smoothing) * self.latency[out_dirs]
+        self.latency[out_dirs] = measured
+
+def run_static(executor: ProcessPoolExecutor, work: list):
+    '''Submit all the predefined slices at once'''
+    futures = {executor.submit(run_work, w): w for w in work}
+    progress_bar = tqdm(total=sum(len(w[1]) for w in work))
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception:
+            error(f'Task failed: {", ".join(futures[future][0])} on {", ".join(futures[future][2])}')
+            print(traceback.format_exc())
+        progress_bar.update(len(futures[future][1]))
+    progress_bar.close()
+
+def run_dynamic(executor: ProcessPoolExecutor, jobs: list, workers: int):
+    '''Feed chunks to the pool as workers finish, keeping every worker busy'''
+    scheduler = dynamic_scheduler(jobs, workers)
+    progress_bar = tqdm(total=scheduler.total_remaining())
+    futures = {}
+
+    def submit():
+        work = scheduler.next_work()
+        if work is not None:
+            futures[executor.submit(run_work, work)] = work
+
+    # one queued chunk per worker on top of the running ones, so workers never wait
+    for _ in range(2 * workers):
+        submit()
+
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            work = futures.pop(future)
+            try:
+                images, elapsed = future.result()
+                scheduler.update(work[2], images, elapsed)
+            except Exception:
+                error(f'Task failed: {", ".join(work[0])} on {", ".join(work[2])}')
+                print(traceback.format_exc())
+            progress_bar.update(len(work[1]))
+            submit()
+    progress_bar.close()
+
+def run_tasks(tasks: list, model_files: dict, workers: int, output: str = '',
+              threshold: float = default_threshold, scheduler: str = 'dynamic'):
+    '''
+    Run prediction tasks on a pool of `workers` processes
+
+    `model_files` contains each model name with the file workers should load
+
+    The 'static' scheduler runs the predefined task slices,
+    the 'dynamic' one splits the work into chunks while running
+    '''
+    if scheduler == 'dynamic':
+        jobs = prepare_jobs(tasks, output)
+        out_dirs = [d for j in jobs for d in j[2]]
+    else:
+        work = prepare_work(tasks, output)
+        out_dirs = [d for w in work for d in w[2]]
+    info(f'Running {scheduler} scheduler on {workers} workers')
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(model_files, threshold)) as executor:
+        if scheduler == 'dynamic':
+            run_dynamic(executor, jobs, workers)
+        else:
+            run_static(executor, work)
+
+    # Print the hash of each predictions folder, as `single` does
+    for out_dir in sorted(set(out_dirs)):
+        info(f'{out_dir} hash={hash_dir(out_dir)}')
@@ -1,18 +1,45 @@
 import os
 import time
 import traceback
+from collections import deque
+from concurrent.futures import (ALL_COMPLETED, FIRST_COMPLETED,
+                                ThreadPoolExecutor, wait)
+from math import ceil
 from shutil import copyfile
 
-import pandas as pd
+import numpy as np
 from PIL import Image
+from PIL.PngImagePlugin import PngInfo
 from tqdm import tqdm
 
+from metrics import eval_metrics
 from utils.db_utils import get_datasets, get_model_filename
 from utils.hash_utils import hash_dir
 from utils.logmanager import *
+from utils.metrics_utils import (calc_mean_metrics, dump_metrics,
+                                 image_metrics, load_groundtruth,
+                                 probability_ext, probability_key)
+from utils.skin_model import (cache_max_bytes, default_threshold, model_groups,
+                              models_cache, skin_model)
 
 method_name = 'probabilistic'
 predictions_dir = os.path.join('..', 'predictions')
+# Marks stdout lines that report progress to a parent process
+progress_prefix = '@progress '
+# Pipelined predictions: threads decoding the next images while the current one is inferred
+decode_threads = 2
+# Pipelined predictions: threads saving predictions and copying x and y in the background
+write_threads = 2
+# Pipelined predictions: images decoded ahead, and images waiting to be saved, at most
+pipeline_depth = 8
+# Threaded inference: images are split into row blocks of at least this many pixels
+min_block_pixels = 1 << 16
+# Threaded inference: thread pools by number of threads, reused by every image
+inference_pools = {}
+# Prediction formats: binary masks, or skin probability maps to binarize at any threshold
+# when measuring (8 or 16-bit grayscale PNG, float32 npy)
+p_formats = ('mask', 'png8', 'png16', 'npy')
+p_dtypes = {'png8': np.uint8, 'png16': np.uint16, 'npy': np.float32}
 
 def get_timestamp() -> str:
     return time.strftime("%Y%m%d-%H%M%S")
@@ -33,21 +60,30 @@ def pred_dir(type: str, timestr: str, name: str) -> str:
     else: # default
         return os.path.join(predictions_dir, name)
 
+def single_pred_dir(model_name: str, target_name: str, output: str = '') -> str:
+    '''Return the directory storing a 1-on-1 prediction, inside `output` if given'''
+    name = f'{model_name}_on_{target_name}'
+    if output == '':
+        return pred_dir(None, None, name)
+    return os.path.join(output, pred_name(name))
+
 def open_image(src):
     # Convert to RGB as some image may be read as RGBA: https://stackoverflow.com/a/54713582
     return Image.open(src,'r').convert('RGB')
 
-def pred_out(path_x: str, out_dir: str) -> list:
+def pred_out(path_x: str, out_dir: str, p_format: str = 'mask') -> list:
     # use the x filename for all saved images filenames (x, y, p)
     filename, x_ext = os.path.splitext(os.path.basename(path_x))
-    # the masks and predictions will be saved LOSSLESS as PNG
-    out_p = os.path.join(out_dir, 'p', filename + '.png')
+    # the masks and predictions will be saved LOSSLESS as PNG (or npy probability maps)
+    p_ext = probability_ext if p_format == 'npy' else '.png'
+    out_p = os.path.join(out_dir, 'p', filename + p_ext)
     out_y = os.path.join(out_dir, 'y', filename + '.png')
     out_x = os.path.join(out_dir, 'x', filename + x_ext)
     return (out_p, out_y, out_x)
 
 # out_bench is the file in which append inference performance data
-def predict(probability, path_x, path_y, out_dir, out_bench: str = ''):
+def predict(model, path_x, path_y, out_dir, out_bench: str = '', threads: int = 1,
+            p_format: str = 'mask'):
     '''
     Create a single prediction image
 
@@ -62,21 +98,21 @@ def predict(probability, path_x, path_y, out_dir, out_bench: str = ''):
     `out_dir` is the prediction output filename
 
     Original image and grountruth files are not copied
+
+    With more than one thread, inference on the image is split among them
+
+    The prediction is a mask, or a probability map if `p_format` is not 'mask'
     '''
-    im = open_image(path_x)
-    temp = im.copy()
-    im.close()
+    temp = decode_image(path_x)
 
     if path_y is not None:
-        out_p, out_y, out_x = pred_out(path_x, out_dir)
+        out_p, out_y, out_x = pred_out(path_x, out_dir, p_format)
     else:
         out_p = out_dir
 
-    # Save p
-    t_elapsed = create_image(temp, probability, out_p)
-
-    # Close file and free memory
-    temp.close()
+    # Save p, closing the image to free memory
+    prediction, t_elapsed = infer_prediction(temp, model, threads, p_format)
+    save_prediction(prediction, out_p)
 
     # Copy x and y
     if path_y is not None: # if its a dataset image (has a groudntruth)
@@ -88,11 +124,77 @@ def predict(probability, path_x, path_y, out_dir, out_bench: str = ''):
         with open(out_bench, 'a') as out:
             out.write(f'{path_x},{t_elapsed}\n')
 
-# Credit to https://stackoverflow.com/a/36469395 for image management with Pillow
-# FUTURE imrpovement: see train.py, use numpy/cv2
-def create_image(im: Image, probability, out_p) -> float:
+def decode_image(path_x: str) -> Image:
+    '''Return an image fully decoded in memory, with its file closed'''
+    im = open_image(path_x)
+    temp = im.copy()
+    im.close()
+    temp.load()
+    return temp
+
+def inference_pool(threads: int) -> ThreadPoolExecutor:
+    if threads not in inference_pools:
+        inference_pools[threads] = ThreadPoolExecutor(threads)
+    return inference_pools[threads]
+
+def encode_probability(probability: np.ndarray, p_format: str) -> np.ndarray:
+    '''
+    Encode skin probabilities as the pixels of a probability map
+
+    npy maps keep the probabilities of the model: binarized at a threshold, they are the masks.
+    PNG maps are approximate: probabilities are scaled to the maximum pixel value and rounded
+    to the nearest, so they are off by up to 1/510 (png8) or 1/131070 (png16), and colours
+    that close to a threshold may binarize otherwise than in the masks.
+    NaN probabilities (colours never seen in training) are skin at any threshold:
+    they are saved as 1 in PNG maps
+    '''
+    dtype = p_dtypes[p_format]
+    if p_format == 'npy':
+        return probability.astype(dtype, copy=False)
+    scale = np.iinfo(dtype).max
+    return np.rint(np.nan_to_num(probability, nan=1.0) * np.float64(scale)).astype(dtype)
+
+def infer_rows(model: skin_model, im_data: np.ndarray, out: np.ndarray, rows: slice,
+               p_format: str = 'mask'):
+    '''Write the prediction of some rows of an RGB image into `out`'''
+    idx = model.index(im_data[rows]) # calculating the serial row number of each pixel
+    if p_format in p_dtypes:
+        out[rows] = encode_probability(model.skin_probability(idx), p_format).reshape(out[rows].shape)
+        return
+    skin = model.is_skin(idx)
+    if p_format == 'skin': # boolean array, measured without saving it
+        out[rows] = skin.reshape(out[rows].shape)
+        return
+    # white (255,255,255) on skin, black (0,0,0) elsewhere
+    block = out[rows].reshape(-1, 3)
+    block[:] = (skin.view(np.uint8) * 255)[:, None]
+
+def infer_array(im_data: np.ndarray, model: skin_model, threads: int = 1,
+                p_format: str = 'mask') -> np.ndarray:
+    '''
+    Return the prediction of a HxWx3 RGB array: a HxWx3 mask,
+    a HxW probability map encoded as `p_format`, or a HxW boolean array if `p_format` is 'skin'
+
+    With more than one thread, the image is split into row blocks inferred in parallel:
+    LUT indexing and lookups are NumPy operations which release the GIL
     '''
-    Infer on an image and save the prediction
+    if p_format == 'mask':
+        out = np.empty_like(im_data)
+    else:
+        out = np.empty(im_data.shape[:2], dtype=p_dtypes.get(p_format, bool))
+    height = im_data.shape[0]
+    blocks = min(threads, height, ceil(im_data.size / 3 / min_block_pixels))
+    if blocks > 1:
+        bounds = [height * b // blocks for b in range(blocks + 1)]
+        rows = [slice(start, end) for start, end in zip(bounds, bounds[1:])]
+        list(inference_pool(threads).map(lambda r: infer_rows(model, im_data, out, r, p_format), rows))
+    else:
+        infer_rows(model, im_data, out, slice(None), p_format)
+    return out
+
+def infer_image(im: Image, model: skin_model, threads: int = 1) -> float:
+    '''
+    Replace the pixels of an image with its prediction mask
 
     Return inference time
     '''
@@ -100,58 +202,348 @@ def create_image(im: Image, probability, out_p) -> float:
 
     t_start = time.time()
     # ALGO
-    newimdata = []
-    
-    for r,g,b in im.getdata():
-        row_num = (r*256*256) + (g*256) + b # calculating the serial row number 
-        if probability['Probability'][row_num] < 0.555555:
-            newimdata.append((0,0,0))
-        else:
-            newimdata.append((255,255,255))
-    
-    im.putdata(newimdata)
+    out = infer_array(np.asarray(im), model, threads)
+
+    # write into the same image so that the saved PNG keeps its metadata
+    im.frombytes(out.tobytes())
+    return time.time() - t_start
+
+def infer_prediction(im: Image, model: skin_model, threads: int = 1, p_format: str = 'mask') -> tuple:
+    '''
+    Return the prediction of an image, to be saved by `save_prediction`, and the inference time
+
+    Masks are written into the image itself, probability maps are arrays:
+    the image is closed
+    '''
+    if p_format == 'mask':
+        return im, infer_image(im, model, threads)
+    im.load()
+    t_start = time.time()
+    prediction = infer_array(np.asarray(im), model, threads, p_format)
     t_elapsed = time.time() - t_start
-    
-    im.save(out_p)
-    return t_elapsed
+    im.close()
+    return prediction, t_elapsed
 
-def make_predictions(image_paths, in_model, out_dir, out_bench: str = '', pbar_position: int = -1):
-    '''Predict over a list of images using the given model'''
-    assert os.path.isfile(in_model), critical('Model file not existing: ' + in_model)
+def save_prediction(prediction, out_p: str):
+    '''Save a mask image, or a probability map'''
+    if isinstance(prediction, Image.Image):
+        try:
+            prediction.save(out_p)
+        finally:
+            prediction.close()
+    elif out_p.endswith(probability_ext):
+        np.save(out_p, prediction)
+    else:
+        # tell the maps from masks, with the pixel value of probability 1
+        pnginfo = PngInfo()
+        pnginfo.add_text(probability_key, str(np.iinfo(prediction.dtype).max))
+        Image.fromarray(prediction).save(out_p, pnginfo=pnginfo)
+
+def write_prediction(prediction, path_x: str, path_y: str, out_dir: str, p_format: str = 'mask'):
+    '''Save a prediction, and copy its original image and grountruth'''
+    out_p, out_y, out_x = pred_out(path_x, out_dir, p_format)
+    save_prediction(prediction, out_p)
+    copyfile(path_x, out_x)
+    copyfile(path_y, out_y)
+
+def infer_targets(im: Image, models: list, threads: int = 1, p_format: str = 'mask'):
+    '''
+    Yield the prediction of a decoded image by each model, to be saved by `save_prediction`,
+    and its inference time
 
-    info("Reading CSV...")
-    probability = pd.read_csv(in_model) # getting the rows from csv
-    if pbar_position == -1: # on multiprocessing do not clog console
-        info('Data collection completed')
+    Masks are written into the image itself: every model but the last one gets a copy,
+    so the image is decoded once whatever the number of models
+    '''
+    for n, model in enumerate(models):
+        target = im if n == len(models) - 1 else im.copy()
+        yield infer_prediction(target, model, threads, p_format)
 
-    # make dirs
-    for basedir in ('p', 'y', 'x'):
-        os.makedirs(os.path.join(out_dir, basedir), exist_ok=True)
-    
-    if pbar_position == -1: # default bar position
-        image_paths_tqdm = tqdm(image_paths)
-    else: # set bar position
-        image_paths_tqdm = tqdm(image_paths, position=pbar_position)
-    
-    for i in image_paths_tqdm:
-        im_abspath = os.path.abspath(i[0]) 
-        y_abspath = os.path.abspath(i[1])
+def predict_sequential(models: list, image_paths, out_dirs: list, out_bench: str = '', threads: int = 1,
+                       p_format: str = 'mask', progress=None):
+    '''
+    Predict one image at a time with every model: decode once, then infer, save and copy for each
+
+    Inference times are appended to `out_bench` if given
+    '''
+    for i in image_paths:
+        path_x = os.path.abspath(i[0])
+        path_y = os.path.abspath(i[1])
 
         # Try predicting
         try:
-            predict(probability, im_abspath, y_abspath, out_dir, out_bench)
+            predictions = infer_targets(decode_image(path_x), models, threads, p_format)
+            for (prediction, t_elapsed), out_dir in zip(predictions, out_dirs):
+                write_prediction(prediction, path_x, path_y, out_dir, p_format)
+                # Save inference performance to file
+                if out_bench: # empty strings are falsy
+                    with open(out_bench, 'a') as out:
+                        out.write(f'{path_x},{t_elapsed}\n')
         # File not found, prediction algo fail, ..
         except Exception:
-            error(f'Failed to infer on image: {im_abspath}')
+            error(f'Failed to infer on image: {path_x}')
             print(traceback.format_exc())
+        if progress is not None:
+            progress(1)
 
-    predictions_hash = hash_dir(out_dir)
+def predict_pipelined(models: list, image_paths, out_dirs: list, threads: int = 1, p_format: str = 'mask',
+                      progress=None):
+    '''
+    Predict with decoding, inference and saving overlapped
 
+    A pool of threads decodes the next images while the current thread looks up the LUT,
+    and another pool saves predictions and copies x and y. Decoding, PNG encoding and
+    copies release the GIL, so they keep other cores busy. At most `pipeline_depth`
+    images are decoded ahead, and as many predictions wait to be saved: memory stays bounded
+
+    Each image is decoded once and predicted by every model, into the matching `out_dirs`
+
+    `progress` is called with 1 each time an image is done: all its predictions are saved
+    '''
+    def failed(path_x: str):
+        error(f'Failed to infer on image: {path_x}')
+        print(traceback.format_exc())
+
+    def release(n: int):
+        # the image is done once it is not being inferred, and none of its predictions is being saved
+        pending[n] -= 1
+        if pending[n] == 0:
+            del pending[n]
+            if progress is not None:
+                progress(1)
+
+    def collect(writes: dict, return_when: str, timeout: float = None):
+        done, _ = wait(writes, timeout=timeout, return_when=return_when)
+        for future in done:
+            n, path_x = writes.pop(future)
+            try:
+                future.result()
+            except Exception:
+                failed(path_x)
+            release(n)
+
+    image_paths = iter(image_paths)
+    with ThreadPoolExecutor(decode_threads) as decoders, ThreadPoolExecutor(write_threads) as writers:
+        # decoding images, in order
+        decodes = deque()
+        # predictions being saved, with the number and path of the image they come from
+        writes = {}
+        # tasks left before each image is done, by image number
+        pending = {}
+        # number of the next image
+        count = 0
+
+        def prefetch():
+            for i in image_paths:
+                path_x = os.path.abspath(i[0])
+                decodes.append((path_x, os.path.abspath(i[1]), decoders.submit(decode_image, path_x)))
+                if len(decodes) >= pipeline_depth:
+                    break
+
+        prefetch()
+        while decodes:
+            path_x, path_y, future = decodes.popleft()
+            n = count
+            count += 1
+            # the inference of the image is pending, as well as each of its writes
+            pending[n] = 1
+            try:
+                predictions = infer_targets(future.result(), models, threads, p_format)
+                for (prediction, _), out_dir in zip(predictions, out_dirs):
+                    # backpressure: wait for the writers if too many predictions are waiting
+                    while len(writes) >= pipeline_depth:
+                        collect(writes, FIRST_COMPLETED)
+                    pending[n] += 1
+                    writes[writers.submit(write_prediction, prediction, path_x, path_y, out_dir,
+                                          p_format)] = (n, path_x)
+            # File not found, prediction algo fail, ..
+            except Exception:
+                failed(path_x)
+            release(n)
+            # report the images saved meanwhile, without waiting for the others
+            collect(writes, ALL_COMPLETED, timeout=0)
+            prefetch()
+        if writes:
+            collect(writes, ALL_COMPLETED)
+
+def decode_pair(path_x: str, path_y: str) -> tuple:
+    '''Return an image as a RGB array, and its grountruth as a boolean array'''
+    im = decode_image(path_x)
+    im_data = np.asarray(im)
+    im.close()
+    return im_data, load_groundtruth(path_y)
+
+def evaluate_targets(models: list, image_paths, out_dirs: list, threads: int = 1,
+                     metric_fns: list = eval_metrics, progress=None) -> list:
+    '''
+    Predict over an iterable of (image, grountruth) paths with every model,
+    and measure each prediction in memory
+
+    Return, for each model, the same measurements as `calc_metrics` on the predictions
+    saved in the matching `out_dirs`, with no prediction saved nor decoded again.
+    Each image and groundtruth is decoded once for all the models: a pool of threads
+    decodes the next ones, at most `pipeline_depth` ahead.
+    `progress` is called with 1 each time an image is measured
+    '''
+    singles = [[] for _ in models]
+    image_paths = iter(image_paths)
+    with ThreadPoolExecutor(decode_threads) as decoders:
+        # decoding images and groundtruths, in order
+        decodes = deque()
+
+        def prefetch():
+            for i in image_paths:
+                path_x = os.path.abspath(i[0])
+                decodes.append((path_x, decoders.submit(decode_pair, path_x, os.path.abspath(i[1]))))
+                if len(decodes) >= pipeline_depth:
+                    break
+
+        prefetch()
+        while decodes:
+            path_x, future = decodes.popleft()
+            try:
+                im_data, y_true = future.result()
+                for model, out_dir, model_singles in zip(models, out_dirs, singles):
+                    y_pred = infer_array(im_data, model, threads, 'skin')
+                    # the paths measure eval would read
+                    out_p, out_y, _ = pred_out(path_x, out_dir)
+                    idata = {'y': out_y, 'p': out_p}
+                    idata.update(image_metrics(y_true, y_pred, metric_fns))
+                    model_singles.append(idata)
+            # File not found, prediction algo fail, ..
+            except Exception:
+                error(f'Failed to infer on image: {path_x}')
+                print(traceback.format_exc())
+            if progress is not None:
+                progress(1)
+            prefetch()
+    return singles
+
+def evaluate_images(model: skin_model, image_paths, out_dir, threads: int = 1,
+                    metric_fns: list = eval_metrics, progress=None) -> list:
+    '''
+    Predict over an iterable of (image, grountruth) paths and measure each prediction in memory
+
+    Return the same measurements as `calc_metrics` on the predictions saved in `out_dir`
+    (see `evaluate_targets`)
+    '''
+    return evaluate_targets([model], image_paths, [out_dir], threads, metric_fns, progress)[0]
+
+def predict_targets(models: list, image_paths, out_dirs: list, out_bench: str = '', pipeline: bool = True,
+                    threads: int = 1, p_format: str = 'mask', progress=None):
+    '''
+    Predict over an iterable of (image, grountruth) paths with every model, logging the images that fail
+
+    Each image is decoded once, and the predictions of `models[k]` are saved in `out_dirs[k]`.
+    Images are pipelined (see `predict_pipelined`) unless `pipeline` is False.
+    When benchmarking, they are predicted one at a time so that timings are not
+    affected by the other stages
+
+    Inference on each image is split among `threads` threads (see `infer_array`),
+    predictions are masks or probability maps as given by `p_format`
+
+    `progress` is called with 1 each time an image is done (saved, or failed)
+    '''
+    assert len(models) == len(out_dirs), 'Each model needs its predictions directory'
+    # make dirs
+    for out_dir in out_dirs:
+        for basedir in ('p', 'y', 'x'):
+            os.makedirs(os.path.join(out_dir, basedir), exist_ok=True)
+
+    if pipeline and not out_bench:
+        predict_pipelined(models, image_paths, out_dirs, threads, p_format, progress)
+    else:
+        predict_sequential(models, image_paths, out_dirs, out_bench, threads, p_format, progress)
+
+def predict_images(model: skin_model, image_paths, out_dir, out_bench: str = '', pipeline: bool = True,
+                   threads: int = 1, p_format: str = 'mask', progress=None):
+    '''Predict over an iterable of (image, grountruth) paths with a model (see `predict_targets`)'''
+    predict_targets([model], image_paths, [out_dir], out_bench, pipeline, threads, p_format, progress)
+
+def report_progress(images: int = 1):
+    '''Tell the parent process on stdout that some images are done'''
+    print(f'{progress_prefix}{images}', flush=True)
+
+def make_target_predictions(image_paths, in_models: list, out_dirs: list, out_bench: str = '',
+                            pbar_position: int = -1, threshold: float = default_threshold,
+                            report: bool = False, threads: int = 1, p_format: str = 'mask',
+                            evaluate: bool = False) -> list:
+    '''
+    Predict over a list of images with several models, decoding each image once
+
+    `in_models` are model filenames or already loaded models (`skin_model`, `sparse_skin_model`),
+    and the predictions of `in_models[k]` go to `out_dirs[k]`
+
+    With more than one thread, inference on each image is split by row blocks among them
+
+    `p_format` is 'mask' to save binary masks, else the format of skin probability maps
+    (see `p_formats`), which can be binarized at any threshold when measuring
+
+    If `evaluate` is True, binary masks are measured in memory instead of being saved
+    (`p_format` must be 'mask'): measurements are dumped as by `measure eval --dump` on each of `out_dirs`
+
+    Return the predictions hash (or the average metrics) of each model.
+    If `report` is True, progress is reported to the parent process instead of
+    showing a progress bar, and None is returned: predictions hashes are not computed
+    '''
+    assert not (evaluate and report), 'Predictions measured in memory cannot be split among processes'
+    assert not evaluate or p_format == 'mask', 'Predictions measured in memory are binary masks'
+    models = []
+    for in_model in in_models:
+        if isinstance(in_model, str):
+            models.append(models_cache.get(in_model, threshold))
+        else:
+            in_model.set_threshold(threshold)
+            models.append(in_model)
     if pbar_position == -1: # on multiprocessing do not clog console
-        print(predictions_hash)
-    return predictions_hash
+        info('Data collection completed')
 
-def base_preds(timestr: str, models: list):
+    if report: # the parent process shows the progress
+        predict_targets(models, image_paths, out_dirs, out_bench, threads=threads, p_format=p_format,
+                        progress=report_progress)
+        return None
+
+    # images are counted when done, not when read: pipelines read them ahead
+    if pbar_position == -1: # default bar position
+        progress_bar = tqdm(total=len(image_paths))
+    else: # set bar position
+        progress_bar = tqdm(total=len(image_paths), position=pbar_position)
+
+    if evaluate:
+        all_singles = evaluate_targets(models, image_paths, out_dirs, threads, progress=progress_bar.update)
+        progress_bar.close()
+        res = []
+        for out_dir, singles in zip(out_dirs, all_singles):
+            avg = calc_mean_metrics(singles, eval_metrics, desc=out_dir, method=method_name)
+            dump_metrics(os.path.basename(os.path.normpath(out_dir)), avg, singles)
+            res.append(avg)
+        return res
+
+    predict_targets(models, image_paths, out_dirs, out_bench, threads=threads, p_format=p_format,
+                    progress=progress_bar.update)
+    progress_bar.close()
+
+    return [hash_dir(out_dir) for out_dir in out_dirs]
+
+def make_predictions(image_paths, in_model, out_dir, out_bench: str = '', pbar_position: int = -1,
+                     threshold: float = default_threshold, report: bool = False, threads: int = 1,
+                     p_format: str = 'mask', evaluate: bool = False):
+    '''
+    Predict over a list of images using the given model (see `make_target_predictions`)
+
+    `in_model` is either a model filename or an already loaded model.
+    Return the predictions hash, or the average metrics if `evaluate` is True
+    '''
+    res = make_target_predictions(image_paths, [in_model], [out_dir], out_bench, pbar_position, threshold,
+                                  report, threads, p_format, evaluate)
+    if res is None:
+        return None
+
+    if pbar_position == -1 and not evaluate: # on multiprocessing do not clog console
+        print(res[0])
+    return res[0]
+
+def base_preds(timestr: str, models: list, threshold: float = default_threshold, threads: int = 1,
+               p_format: str = 'mask', evaluate: bool = False):
     '''
     Base predictions
     For each dataset: the model trained from the training set is used
@@ -165,9 +557,12 @@ def base_preds(timestr: str, models: list):
         # Make predictions
         image_paths = in_model.get_test_paths() # predict on testing set
         out_dir = pred_dir('base', timestr, in_model.name)
-        make_predictions(image_paths, model_name, out_dir)
+        make_predictions(image_paths, model_name, out_dir, threshold=threshold, threads=threads,
+                         p_format=p_format, evaluate=evaluate)
 
-def cross_preds(timestr: str, train_databases: list, predict_databases: list = None):
+def cross_preds(timestr: str, train_databases: list, predict_databases: list = None,
+                threshold: float = default_threshold, threads: int = 1, p_format: str = 'mask',
+                evaluate: bool = False):
     '''
     Cross predictions
     For each dataset: the model trained from the training set is used
@@ -176,18 +571,29 @@ def cross_preds(timestr: str, train_databases: list, predict_databases: list = N
     if predict_databases is None:
         predict_databases = get_datasets() #train_databases
 
-    # Load each model
-    for train_db in train_databases:
-        model_name = get_model_filename(train_db)
+    # Load each model once: all of them if they fit in the model cache, else a group at a time
+    model_files = {get_model_filename(train_db): train_db for train_db in train_databases}
+    groups = model_groups(list(model_files))
+    if len(groups) > 1:
+        info(f'Models do not fit in {cache_max_bytes / 1024 ** 2:.0f} MB: predicting in {len(groups)} groups')
+    for group in groups:
+        models = {model_files[f]: models_cache.get(f, threshold) for f in group}
 
-        # Load each target
+        # Load each target: its images are decoded once for every model of the group
         for predict_db in predict_databases:
             # do not predict on self
-            if train_db == predict_db:
+            train_dbs = [train_db for train_db in models if train_db != predict_db]
+            if not train_dbs:
                 continue
-            
+
             assert os.path.isdir(predict_db.dir), 'Dataset has no directory: ' + predict_db.name
             # Make predictions
             image_paths = predict_db.get_all_paths() # predict the whole dataset
-            out_dir = pred_dir('cross', timestr, f'{train_db.name}_on_{predict_db.name}')
-            make_predictions(image_paths, model_name, out_dir)
+            out_dirs = [pred_dir('cross', timestr, f'{train_db.name}_on_{predict_db.name}')
+                        for train_db in train_dbs]
+            res = make_target_predictions(image_paths, [models[train_db] for train_db in train_dbs],
+                                          out_dirs, threshold=threshold, threads=threads,
+                                          p_format=p_format, evaluate=evaluate)
+            if not evaluate:
+                for out_dir, predictions_hash in zip(out_dirs, res):
+                    info(f'{out_dir} hash={predictions_hash}')
@@ -2,9 +2,13 @@ import os
 import shutil
 import unittest
 
+from train import do_training
 from utils.logmanager import *
 
 code_dir = 'code'
+docs_dir = os.path.join('..', 'docs')
+# Sample images of the docs, which have a groundtruth
+docs_images = ('infohiding', 'st-vincent-actor-album-art')
 
 def set_working_dir(test: unittest.TestCase):
     '''Make the tests start with working dir = code directory'''
@@ -15,6 +19,21 @@ def set_working_dir(test: unittest.TestCase):
     test.assertIsNotNone(current_dir)
     test.assertEqual(os.path.basename(current_dir), code_dir)
 
+def docs_image_paths(names: tuple = docs_images) -> list:
+    '''Return the (image, groundtruth) paths of sample images of the docs'''
+    return [(os.path.join(docs_dir, 'x', f'{i}.jpg'), os.path.join(docs_dir, 'y', f'{i}.png')) for i in names]
+
+def train_docs_model(out_dir: str, image_paths: list = None, name: str = 'docs.npy', **kwargs) -> str:
+    '''
+    Train a model into `out_dir` (eg. a temporary directory) and return its filename
+
+    The model is trained on all the sample images of the docs, unless `image_paths` are given.
+    Other keyword arguments are passed to `do_training`
+    '''
+    model_file = os.path.join(out_dir, name)
+    do_training(docs_image_paths() if image_paths is None else image_paths, model_file, **kwargs)
+    return model_file
+
 def search_subdir(root_dir: str, target_name: str) -> str:
     '''
     Search inside a directory for the most recent matching subdirectory
@@ -1,16 +1,21 @@
 import json
+import tempfile
 import unittest
 
+import click
 import numpy as np
 from cli.measure import dump_dir, eval
+from cli.singlepredict import check_evaluate
 from click.testing import CliRunner
 from metrics import *
 from utils.logmanager import *
-from utils.metrics_utils import load_images
+from predict import evaluate_images, p_formats, predict_images
+from utils.metrics_utils import calc_metrics, load_images
+from utils.skin_model import open_model
 
-from tests.helper import set_working_dir
+from tests.helper import (docs_dir, docs_image_paths, set_working_dir,
+                          train_docs_model)
 
-docs_dir = os.path.join('..', 'docs')
 docs_y_path = os.path.join(docs_dir, 'y')
 docs_p_path = os.path.join(docs_dir, 'p')
 
@@ -285,6 +290,59 @@ class TestMetrics(unittest.TestCase):
             for key in singles[i]:
                 self.assertEqual(singles[i][key], sample_results[i][key], 'Key value not equal: ' + key)
 
+    def test_probability_maps(self):
+        '''Probability maps binarized on read measure as the masks predicted at the same threshold'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+        metrics = [f1, iou_logical, recall, precision]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            model_file = train_docs_model(tmp, image_paths[:1])
+
+            for threshold in (0.555555, 0.3):
+                model = open_model(model_file, threshold)
+                masks = os.path.join(tmp, f'mask_{threshold}')
+                predict_images(model, image_paths, masks)
+                expected = calc_metrics(os.path.join(masks, 'y'), os.path.join(masks, 'p'), metrics)
+
+                for p_format in p_formats[1:]:
+                    maps = os.path.join(tmp, p_format)
+                    if not os.path.isdir(maps):
+                        predict_images(model, image_paths, maps, p_format=p_format)
+                    measured = calc_metrics(os.path.join(maps, 'y'), os.path.join(maps, 'p'), metrics,
+                                            p_threshold=threshold)
+                    if p_format == 'npy': # the probabilities of the model: exactly the masks
+                        for e, m in zip(expected, measured):
+                            self.assertEqual({f.__name__: e[f.__name__] for f in metrics},
+                                             {f.__name__: m[f.__name__] for f in metrics},
+                                             msg=f'{p_format} at {threshold}')
+                        continue
+                    for e, m in zip(expected, measured):
+                        for metric in metrics:
+                            self.assertAlmostEqual(e[metric.__name__], m[metric.__name__], places=3,
+                                                   msg=f'{p_format} {metric.__name__} at {threshold}')
+
+    def test_fused_eval(self):
+        '''Predictions measured in memory have the same metrics as saved predictions'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            model = open_model(train_docs_model(tmp, image_paths[:1]))
+
+            out_dir = os.path.join(tmp, 'docs_on_docs')
+            predict_images(model, image_paths, out_dir)
+            expected = calc_metrics(os.path.join(out_dir, 'y'), os.path.join(out_dir, 'p'), eval_metrics)
+            measured = evaluate_images(model, image_paths, out_dir)
+            self.assertEqual(sorted(measured, key=lambda d: d['y']), sorted(expected, key=lambda d: d['y']))
+
+        # probability maps are not measured in memory
+        check_evaluate(True, 'mask')
+        with self.assertRaises(click.UsageError):
+            check_evaluate(True, 'npy')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,15 +1,29 @@
 import os
+import shlex
+import tempfile
+import threading
 import unittest
+from shutil import copyfile
 
-from cli.multipredict import batch_multi, single_multi
+import cli.multipredict as multipredict
+from cli.multipredict import (batch_multi, generate_commands, generate_tasks,
+                              order_tasks, partition_by_cost, run_command,
+                              run_engine, single_multi)
 from click.testing import CliRunner
-from predict import predictions_dir
+from pool import dynamic_scheduler
+import predict
+import utils.skin_model as skin_model_module
+from predict import (decode_image, infer_image, predict_images, predict_targets,
+                     predictions_dir)
 from utils.db_utils import gen_pred_folders, get_db_by_name, get_models
 from utils.hash_utils import hash_dir
 from utils.logmanager import *
 from utils.Schmugge import light, medium
+from utils.skin_model import (model_cache, model_groups, model_nbytes,
+                              open_model)
 
-from tests.helper import search_subdir, set_working_dir, rm_folder
+from tests.helper import (docs_image_paths, rm_folder, search_subdir,
+                          set_working_dir, train_docs_model)
 
 # xxh3_64 hashes of prediction folders already generated for thesis
 hashes = {
@@ -157,6 +171,199 @@ class TestMultipredict(unittest.TestCase):
         info('TESTING RESULTING PREDICTIONS...')
         self.check_predictions_folders(predictions)
 
+    def test_pipeline(self):
+        '''Pipelined predictions are the same as predictions made one image at a time'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+        # a missing image is logged and skipped
+        missing = docs_image_paths(('missing',))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            model = open_model(train_docs_model(tmp))
+
+            sequential = os.path.join(tmp, 'sequential')
+            pipelined = os.path.join(tmp, 'pipelined')
+            predict_images(model, image_paths + missing, sequential, pipeline=False)
+            # images are done when their prediction is saved, not when they are read ahead
+            done = []
+            progress = lambda images: done.append(len(os.listdir(os.path.join(pipelined, 'p'))))
+            predict_images(model, missing + image_paths, pipelined, progress=progress)
+            self.assertEqual(len(os.listdir(os.path.join(pipelined, 'p'))), len(image_paths))
+            self.assertEqual(len(done), len(missing + image_paths))
+            for reported, saved in enumerate(done):
+                self.assertGreaterEqual(saved, reported)
+            self.assertEqual(hash_dir(pipelined), hash_dir(sequential))
+
+    def test_threads(self):
+        '''Inference split by row blocks among threads gives the same prediction'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()[:1]
+        x_path = image_paths[0][0]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            model = open_model(train_docs_model(tmp, image_paths))
+
+            single = decode_image(x_path)
+            infer_image(single, model)
+            # split even small images
+            min_block_pixels = predict.min_block_pixels
+            predict.min_block_pixels = 1
+            try:
+                for threads in (2, 3, 8):
+                    threaded = decode_image(x_path)
+                    infer_image(threaded, model, threads)
+                    self.assertEqual(threaded.tobytes(), single.tobytes())
+            finally:
+                predict.min_block_pixels = min_block_pixels
+
+    def test_targets(self):
+        '''Images decoded once for several models give the predictions of each model alone'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            models = [open_model(train_docs_model(tmp, [i], f'docs{n}.npy')) for n, i in enumerate(image_paths)]
+
+            for p_format in ('mask', 'png8'):
+                for pipeline in (True, False):
+                    out_dirs = [os.path.join(tmp, f'{p_format}_{pipeline}_{n}') for n in range(len(models))]
+                    predict_targets(models, image_paths, out_dirs, pipeline=pipeline, p_format=p_format)
+                    for model, out_dir in zip(models, out_dirs):
+                        alone = out_dir + '_alone'
+                        predict_images(model, image_paths, alone, pipeline=False, p_format=p_format)
+                        self.assertEqual(hash_dir(out_dir), hash_dir(alone))
+
+    def test_model_groups(self):
+        '''Models are grouped in order to fit the cache cap, as sized once loaded'''
+        set_working_dir(self)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            model_files = [train_docs_model(tmp, name=f'docs.{ext}') for ext in ('npy', 'npz')]
+            for model_file in model_files:
+                self.assertEqual(model_nbytes(model_file), open_model(model_file).nbytes())
+
+            # a cap fitting 2 out of 3 models
+            nbytes = model_nbytes(model_files[0])
+            groups = model_groups(model_files + model_files[:1], 2 * nbytes)
+            self.assertEqual(groups, [model_files, model_files[:1]])
+            self.assertEqual(model_groups(model_files, nbytes - 1), [[f] for f in model_files])
+
+    def test_model_cache(self):
+        '''The least recently used model is evicted past the byte budget, and cache hits are not reloaded'''
+        set_working_dir(self)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            model_files = [train_docs_model(tmp, name='a.npy')]
+            for name in ('b.npy', 'c.npy'):
+                model_files.append(os.path.join(tmp, name))
+                copyfile(model_files[0], model_files[-1])
+            a, b, c = model_files
+
+            loads = []
+            def counting_open_model(filename: str, *args, **kwargs):
+                loads.append(filename)
+                return open_model(filename, *args, **kwargs)
+
+            # a budget fitting 2 out of 3 models
+            cache = model_cache(2 * model_nbytes(a))
+            skin_model_module.open_model = counting_open_model
+            try:
+                model = cache.get(a)
+                cache.get(b)
+                self.assertIs(cache.get(a, 0.3), model)
+                self.assertEqual(loads, [a, b])
+                # b is the least recently used
+                cache.get(c)
+                self.assertEqual([k[0] for k in cache.models], [os.path.abspath(a), os.path.abspath(c)])
+                cache.get(a)
+                cache.get(b)
+            finally:
+                skin_model_module.open_model = open_model
+            self.assertEqual(loads, [a, b, c, b])
+            self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_shared_cleanup(self):
+        '''Models already shared are removed if sharing another one fails'''
+        set_working_dir(self)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            created = []
+            def share_model(filename: str) -> str:
+                if created:
+                    raise OSError('No space left on device')
+                created.append(os.path.join(tmp, 'skin-shared.npy'))
+                open(created[-1], 'w').close()
+                return created[-1]
+
+            original = multipredict.share_model
+            multipredict.share_model = share_model
+            try:
+                with self.assertRaises(OSError):
+                    run_engine('pool', [], ['ECU', 'HGR_small'], 1, False)
+            finally:
+                multipredict.share_model = original
+            self.assertEqual(len(created), 1)
+            self.assertFalse(os.path.exists(created[0]))
+
+    def test_partition_by_cost(self):
+        '''Tasks are contiguous slices covering every image, of similar cost, ordered longest-first'''
+        costs = [0.3] * 10 + [2.0, 0.1, 0.1, 5.0] + [0.3] * 6
+        for parts in (1, 3, 4, 20, 30):
+            slices = partition_by_cost(costs, parts)
+            self.assertLessEqual(len(slices), parts)
+            self.assertEqual(slices[0][0], 0)
+            self.assertEqual(slices[-1][1], len(costs))
+            for (_, end), (start, _) in zip(slices, slices[1:]):
+                self.assertEqual(end, start)
+
+        tasks = order_tasks(generate_tasks(costs, 4, 'ECU', 'VPU'))
+        self.assertEqual(sorted((t['from'], t['to']) for t in tasks), partition_by_cost(costs, 4))
+        self.assertEqual([t['cost'] for t in tasks], sorted((t['cost'] for t in tasks), reverse=True))
+        self.assertEqual([t['bar'] for t in tasks], list(range(len(tasks))))
+
+    def test_run_command(self):
+        '''Progress reports of a child update the bar, and its other output, stderr included, goes above it'''
+        class fake_bar(object):
+            def __init__(self):
+                self.n = 0
+                self.lines = []
+            def update(self, n: int):
+                self.n += n
+            def write(self, line: str):
+                self.lines.append(line)
+
+        child = ("import sys; print('@progress 2', flush=True); print('log', file=sys.stderr, flush=True); "
+                 "print('@progress 3', flush=True); sys.exit(4)")
+        bar = fake_bar()
+        self.assertEqual(run_command(f'python -c "{child}"', bar, threading.Lock()), 4)
+        self.assertEqual(bar.n, 5)
+        self.assertEqual(bar.lines, ['log'])
+
+    def test_generate_commands(self):
+        '''Paths with spaces are single arguments of the commands'''
+        tasks = generate_tasks([0.3] * 4, 1, 'ECU', 'VPU')
+        shared = {'ECU': '/dev/shm/skin shared.npy'}
+        files = {'ECU': '../models/ECU model.npz'}
+        cmd = generate_commands(tasks, 'my predictions', shared_models=shared, model_files=files)[0]
+        args = shlex.split(cmd)
+        for arg in ('--model-file=../models/ECU model.npz', '--output=my predictions',
+                    '--shared-model=/dev/shm/skin shared.npy'):
+            self.assertIn(arg, args)
+
+    def test_dynamic_scheduler(self):
+        '''Unmeasured jobs get their first chunks in turn, then the longest remaining job goes first'''
+        jobs = [[(m,), list(range(100)), (f'{m}_dir',), 0] for m in ('a', 'b', 'c')]
+        scheduler = dynamic_scheduler(jobs, 2)
+        first = [scheduler.next_work() for _ in range(4)]
+        self.assertEqual([w[2] for w in first], [('a_dir',), ('b_dir',), ('c_dir',), ('a_dir',)])
+
+        for work, latency in zip(first[:3], (0.1, 0.5, 0.2)):
+            scheduler.update(work[2], len(work[1]), latency * len(work[1]))
+        self.assertEqual(scheduler.next_work()[2], ('b_dir',))
+
 
 if __name__ == '__main__':
     unittest.main()
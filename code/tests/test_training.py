@@ -1,13 +1,32 @@
+import os
+import tempfile
 import unittest
+from shutil import copyfile
+from unittest import mock
 
+import numpy as np
+import train as train_module
+from cli.singlepredict import image
 from cli.training import train
 from click.testing import CliRunner
+from crossval import (count_folds, cross_validate, evaluate_fold, fold_model,
+                      make_folds)
+from metrics import eval_metrics
+from predict import evaluate_images, infer_array
+from train import (combine_models, count_parallel, do_training,
+                   do_training_all, lut_deviation, pixel_sampler, read_image,
+                   read_image_array, sampling_error, save_trained,
+                   train_data, train_data_array)
+from utils import db_utils
 from utils.db_utils import get_model_filename
 from utils.hash_utils import hash_file
+from utils.histograms import load_counts
 from utils.logmanager import *
+from utils.skin_model import (colour_spaces, convert_colours, load_model,
+                              open_model, read_header)
 from utils.Schmugge import medium
 
-from tests.helper import set_working_dir
+from tests.helper import docs_image_paths, set_working_dir, train_docs_model
 
 # xxh3_64 hashes of models already generated for thesis
 hashes = {
@@ -46,10 +65,306 @@ class TestTrain(unittest.TestCase):
         #for d in get_trainable():
         for d in [medium()]:
             if d.name in hashes:
-                model_name = get_model_filename(d)
+                model_name = get_model_filename(d, 'csv')
                 info('Testing model named ' + model_name)
                 self.assertEqual(hash_file(model_name), hashes[d.name])
 
+    def test_engines(self):
+        '''Numpy and python training engines build the same histograms'''
+        set_working_dir(self)
+
+        hists = {}
+        for engine in ('numpy', 'python'):
+            skin = np.zeros((256,256,256))
+            non_skin = np.zeros((256,256,256))
+            for x_path, y_path in docs_image_paths():
+                if engine == 'numpy':
+                    skin, non_skin = train_data_array(read_image_array(x_path),
+                        read_image_array(y_path), skin, non_skin)
+                else:
+                    skin, non_skin = train_data(read_image(x_path),
+                        read_image(y_path), skin, non_skin)
+            hists[engine] = (skin, non_skin)
+
+        for a, b in zip(hists['numpy'], hists['python']):
+            self.assertTrue(np.array_equal(a, b))
+
+    def test_parallel(self):
+        '''Parallel training reduces to the same histograms as the sequential one'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+
+        skin = np.zeros((256,256,256))
+        non_skin = np.zeros((256,256,256))
+        for x_path, y_path in image_paths:
+            skin, non_skin = train_data_array(read_image_array(x_path),
+                read_image_array(y_path), skin, non_skin)
+
+        p_skin, p_non_skin = count_parallel(image_paths, 2,
+            np.zeros((256,256,256)), np.zeros((256,256,256)))
+        self.assertTrue(np.array_equal(skin, p_skin))
+        self.assertTrue(np.array_equal(non_skin, p_non_skin))
+
+    def test_parallel_checkpoints(self):
+        '''The same training workers count every checkpoint into the same model'''
+        set_working_dir(self)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            sequential = train_docs_model(tmp, name='sequential.npy')
+            # one checkpoint per image: partial counts are reduced and zeroed in between
+            checkpoint_images = train_module.checkpoint_images
+            train_module.checkpoint_images = 1
+            try:
+                parallel = train_docs_model(tmp, name='parallel.npy', workers=2)
+            finally:
+                train_module.checkpoint_images = checkpoint_images
+            self.assertEqual(read_header(sequential)['hash'], read_header(parallel)['hash'])
+
+            # partial counts are reduced before they can overflow, even within a checkpoint
+            max_worker_pixels = train_module.max_worker_pixels
+            train_module.max_worker_pixels = 1
+            try:
+                bounded = train_docs_model(tmp, name='bounded.npy', workers=2)
+            finally:
+                train_module.max_worker_pixels = max_worker_pixels
+            self.assertEqual(read_header(sequential)['hash'], read_header(bounded)['hash'])
+
+    def test_near_threshold(self):
+        '''Colours just below the threshold are non skin for CSV, native and sparse models alike'''
+        set_working_dir(self)
+
+        skin = np.zeros((256,256,256), dtype=np.uint32)
+        non_skin = np.zeros((256,256,256), dtype=np.uint32)
+        # probability 0.55555496, which rounds to the threshold 0.555555 as float32
+        skin[10, 20, 30], non_skin[10, 20, 30] = 102991, 82393
+        skin[200, 150, 120] = 1
+        non_skin[0, 0, 0] = 1
+        im = np.array([[[10, 20, 30], [200, 150, 120], [0, 0, 0]]], dtype=np.uint8)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            masks = []
+            for ext in ('csv', 'npy', 'npz'):
+                out = os.path.join(tmp, f'near.{ext}')
+                save_trained(skin, non_skin, out)
+                masks.append(infer_array(im, open_model(out)))
+            masks.append(infer_array(im, open_model(os.path.join(tmp, 'near.npz'), sparse=True)))
+            self.assertTrue(np.array_equal(masks[0][0, :, 0], [0, 255, 0]))
+            for mask in masks[1:]:
+                self.assertTrue(np.array_equal(mask, masks[0]))
+
+    def test_update(self):
+        '''Adding images to saved counts gives the same model as training on all of them'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            full = train_docs_model(tmp, name='full.npy')
+            incremental = train_docs_model(tmp, image_paths[:1], 'incremental.npy')
+            self.assertEqual(len(load_counts(incremental)[2]), 1)
+            # the manifest is committed along with the counts, in the same file
+            self.assertEqual(sorted(f for f in os.listdir(tmp) if f.startswith('incremental.')),
+                             ['incremental.json', 'incremental.npy', 'incremental.npy.counts.npz'])
+            # other formats of the same model have their own counts
+            train_docs_model(tmp, name='incremental.npz', bits=5, space='cbcr')
+            with self.assertLogs('skin') as logs:
+                do_training(image_paths, incremental, update=True)
+            self.assertTrue(any('Images already counted: 1, to count: 1' in m for m in logs.output))
+
+            self.assertEqual(read_header(full)['hash'], read_header(incremental)['hash'])
+            self.assertEqual(read_header(incremental)['images'], 2)
+
+    def test_sparse(self):
+        '''Sparse models expand to the native LUT, and binary searches give the same decisions'''
+        set_working_dir(self)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            native = train_docs_model(tmp, name='model.npy')
+            sparse = train_docs_model(tmp, name='model.npz')
+
+            self.assertTrue(np.array_equal(load_model(native), load_model(sparse), equal_nan=True))
+            self.assertEqual(read_header(sparse)['images'], 2)
+
+            idx = np.arange(256 ** 3, dtype=np.uint32)
+            for threshold in (0.2, 0.555555):
+                dense_model = open_model(sparse, threshold)
+                sparse_model = open_model(sparse, threshold, sparse=True)
+                self.assertTrue(np.array_equal(dense_model.is_skin(idx), sparse_model.is_skin(idx)))
+
+    def test_model_filename(self):
+        '''Predictions use the most recently written model of a dataset, whatever its format'''
+        set_working_dir(self)
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(db_utils, 'models_dir', tmp):
+            self.assertEqual(get_model_filename(medium()), get_model_filename(medium(), 'csv'))
+            for mtime, format in enumerate(('npy', 'csv', 'npz')):
+                open(get_model_filename(medium(), format), 'w').close()
+                os.utime(get_model_filename(medium(), format), (mtime, mtime))
+                self.assertEqual(get_model_filename(medium()), get_model_filename(medium(), format))
+            # written at the same time: by order of preference
+            os.utime(get_model_filename(medium(), 'npy'), (2, 2))
+            self.assertEqual(get_model_filename(medium()), get_model_filename(medium(), 'npy'))
+
+    def test_bits(self):
+        '''Quantized histograms are the full resolution ones summed over coarser bins'''
+        set_working_dir(self)
+
+        x_path, y_path = docs_image_paths()[0]
+        im = read_image_array(x_path)
+        y = read_image_array(y_path)
+
+        skin, non_skin = train_data_array(im, y, np.zeros((256,256,256)), np.zeros((256,256,256)))
+        q_skin, q_non_skin = train_data_array(im, y, np.zeros((32,32,32)), np.zeros((32,32,32)))
+        for hist, q_hist in ((skin, q_skin), (non_skin, q_non_skin)):
+            self.assertTrue(np.array_equal(hist.reshape(32,8,32,8,32,8).sum(axis=(1,3,5)), q_hist))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for ext in ('npy', 'npz'):
+                out = train_docs_model(tmp, [(x_path, y_path)], f'model.{ext}', bits=5)
+                self.assertEqual(read_header(out)['bits'], 5)
+                self.assertEqual(open_model(out).lut.size, 32 ** 3)
+                # inference quantizes colours as the model
+                self.assertLess(open_model(out).index(im).max(), 32 ** 3)
+
+    def test_all(self):
+        '''Single-pass training of overlapping datasets gives the same models as separate trainings'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+        datasets = {'first': image_paths[:1], 'both': image_paths, 'second': image_paths[1:]}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            trainings = [(paths, os.path.join(tmp, f'{name}.npy'), name) for name, paths in datasets.items()]
+            do_training_all(trainings)
+            for paths, out, name in trainings:
+                single = train_docs_model(tmp, paths, f'{name}_single.npy')
+                self.assertEqual(read_header(out)['hash'], read_header(single)['hash'])
+                self.assertEqual(len(load_counts(out)[2]), len(paths))
+
+    def test_combine(self):
+        '''Merging models gives the model trained on all their images, subtracting takes them back'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            first = train_docs_model(tmp, image_paths[:1], 'first.npz')
+            # counts of native models are read from the counts saved by training
+            second = train_docs_model(tmp, image_paths[1:], 'second.npy')
+            both = train_docs_model(tmp, name='both.npy')
+
+            merged = os.path.join(tmp, 'merged.npy')
+            provenance = combine_models([first, second], [1, 1], merged)
+            self.assertEqual(read_header(merged)['hash'], read_header(both)['hash'])
+            self.assertEqual([p['weight'] for p in read_header(merged)['provenance']], [1, 1])
+            self.assertEqual(provenance, read_header(merged)['provenance'])
+
+            # merged models are predicted with by file
+            x_path = os.path.join(tmp, 'x.jpg')
+            copyfile(image_paths[0][0], x_path)
+            result = CliRunner().invoke(image, ['--model-file', merged, '-p', x_path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            predicted = read_image_array(os.path.join(tmp, 'x_p.png'))
+            self.assertTrue(np.array_equal(predicted, infer_array(read_image_array(x_path), open_model(both))))
+
+            subtracted = os.path.join(tmp, 'subtracted.npy')
+            combine_models([both, second], [1, -1], subtracted)
+            self.assertTrue(np.array_equal(load_model(subtracted), load_model(first), equal_nan=True))
+
+    def test_colour_spaces(self):
+        '''Models in other colour spaces record it, and infer in the same colour space'''
+        set_working_dir(self)
+
+        pixels = np.array([[255, 0, 0], [0, 0, 0], [10, 10, 10]], dtype=np.uint8)
+        self.assertTrue(np.array_equal(convert_colours(pixels, 'rg'), [[255, 0], [0, 0], [85, 85]]))
+        self.assertTrue(np.array_equal(convert_colours(pixels, 'cbcr'),
+                                       convert_colours(pixels, 'ycbcr')[:, 1:]))
+        self.assertTrue(np.array_equal(convert_colours(pixels, 'hs'),
+                                       convert_colours(pixels, 'hsv')[:, :2]))
+
+        image_paths = docs_image_paths()[:1]
+        im = read_image_array(image_paths[0][0])
+        with tempfile.TemporaryDirectory() as tmp:
+            for space, channels in colour_spaces.items():
+                out = train_docs_model(tmp, image_paths, f'{space}.npy', space=space)
+                model = open_model(out)
+                self.assertEqual(read_header(out)['colour_space'], space)
+                self.assertEqual(model.lut.size, 256 ** channels)
+                self.assertEqual(model.index(im).size, im.shape[0] * im.shape[1])
+
+    def test_crossval(self):
+        '''Fold models taken out of the total counts are the models trained on the other folds'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+        folds = make_folds(image_paths, 2, seed=0)
+        self.assertEqual(folds, make_folds(image_paths, 2, seed=0))
+        self.assertEqual(sorted(folds[0] + folds[1]), sorted(image_paths))
+
+        fold_counts, skin, non_skin = count_folds(folds)
+        with tempfile.TemporaryDirectory() as tmp:
+            for f in range(2):
+                out = train_docs_model(tmp, folds[1 - f], f'fold{f}.npy')
+                model = fold_model(fold_counts[f], skin, non_skin)
+                self.assertTrue(np.array_equal(model.lut, load_model(out), equal_nan=True))
+
+                # held-out images are measured as `measure eval` measures their predictions
+                expected = evaluate_images(model, folds[f], tmp)
+                for single, measured in zip(expected, evaluate_fold(model, folds[f], eval_metrics)):
+                    self.assertEqual({k: v for k, v in single.items() if k not in ('y', 'p')},
+                                     {k: v for k, v in measured.items() if k not in ('y', 'x')})
+
+        res = cross_validate(image_paths, k=2, seed=0)
+        self.assertEqual(len(res['folds']), 2)
+        self.assertIn('f1', res['summary'])
+
+    def test_sampling(self):
+        '''Sampled trainings count the pixels selected, and report their deviation from full trainings'''
+        set_working_dir(self)
+
+        image_paths = docs_image_paths()
+        im = read_image_array(image_paths[0][0])
+        y = read_image_array(image_paths[0][1])
+        pixels = im.shape[0] * im.shape[1]
+
+        for method in ('stride', 'random'):
+            sampler = pixel_sampler(0.1, method=method, seed=1)
+            sampled_im, sampled_y = sampler.sample(im, y, image_paths[0][0])
+            self.assertEqual(sampled_im.shape, (sampler.sample_size(pixels), 3))
+            self.assertTrue(np.array_equal(sampled_im, sampler.sample(im, y, image_paths[0][0])[0]))
+        self.assertEqual(len(pixel_sampler(max_pixels=100).sample(im, y, image_paths[0][0])[0]), 100)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            full = train_docs_model(tmp, name='full.npy')
+            sampled_all = train_docs_model(tmp, name='all.npy', sampler=pixel_sampler())
+            self.assertEqual(read_header(full)['hash'], read_header(sampled_all)['hash'])
+
+            out = train_docs_model(tmp, name='sampled.npy', sampler=pixel_sampler(0.25), reference=full)
+            skin, non_skin, _ = load_counts(out, sampling=pixel_sampler(0.25).describe())
+            self.assertLess(skin.sum() + non_skin.sum(), pixels)
+            self.assertIsNone(load_counts(out))
+
+            error = sampling_error(skin, non_skin, 0.25)
+            self.assertGreater(error['max'], 0)
+            self.assertEqual(sampling_error(skin, non_skin, 1.0)['max'], 0)
+            deviation = lut_deviation(load_model(out), load_model(full))
+            self.assertEqual(deviation['colours'], error['colours'])
+            self.assertEqual(lut_deviation(load_model(full), load_model(full))['max'], 0)
+
+            # references of other bits or colour spaces are rejected before counting
+            for kwargs in ({'bits': 6}, {'space': 'ycbcr'}):
+                with self.assertRaises(AssertionError):
+                    train_docs_model(tmp, name='other.npz', sampler=pixel_sampler(0.25), reference=full, **kwargs)
+                self.assertFalse(os.path.exists(os.path.join(tmp, 'other.npz.counts.npz')))
+
+            # the reference is read before the sampled model replaces it
+            with self.assertLogs('skin') as logs:
+                train_docs_model(tmp, name='full.npy', sampler=pixel_sampler(0.25), reference=full)
+            reported = [m for m in logs.output if 'Deviation from' in m]
+            self.assertEqual(len(reported), 1)
+            self.assertNotIn('max 0.0000', reported[0])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,16 +1,51 @@
 import csv
 import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from math import ceil
+from multiprocessing import Queue, shared_memory
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 import numpy as np
+import psutil
 from tqdm import tqdm
 
 from predict import open_image
+from utils.cost_utils import read_image_size
+from utils.histograms import (count_indexes, hash_image, image_key,
+                              load_counts, load_model_counts, save_counts)
 from utils.logmanager import *
+from utils.skin_model import (below_threshold, colour_index, colour_spaces,
+                              default_bits, default_space, default_threshold,
+                              load_model, lut_bits, lut_length, lut_size,
+                              model_layout, native_ext, save_model,
+                              save_sparse_model, sparse_counts, sparse_ext)
 
 # FUTURE improvement ideas
-# -use sparse matrix for saving model
-# -use numpy to avoid the 3d histogram nested loops in data()
+# -write the CSV rows of data() with numpy instead of a loop per (R,G) pair
 # -use cv2 to read images, should be faster
 
+# Available training engines
+engines = ('numpy', 'python')
+# Count histograms are saved every this many images
+checkpoint_images = 256
+# Counts are uint32: histograms are promoted to uint64 only if more pixels than this are counted
+max_counts = np.iinfo(np.uint32).max
+# Probabilities are computed this many colours at a time
+probability_block = 1 << 20
+# Parallel training: images sent to a worker at a time
+shard_size = 16
+# Parallel training: partial counts are uint32, they are reduced every this many pixels at most
+max_worker_pixels = max_counts
+# Pixel sampling methods
+samplings = ('stride', 'random')
+# Sampling error is reported as the half-width of this confidence interval (95%)
+confidence_z = 1.96
+
 
 ## this function reads image and get RGB data
 def read_image(path: str):
@@ -20,6 +55,13 @@ def read_image(path: str):
     im.close()
     return list(im_data) # listing all rgb into a list
 
+def read_image_array(path: str) -> np.ndarray:
+    '''Return an image as a HxWx3 uint8 array of R,G,B values'''
+    im = open_image(path)
+    im_data = np.asarray(im)
+    im.close()
+    return im_data
+
 def is_skin(rgb, threshold: int = 150):
     '''Grountruth pixel is skin if it is whiteish'''
     r, g, b = rgb
@@ -38,22 +80,133 @@ def train_data(im_data, y_data, skin, non_skin):
             non_skin[r][g][b] += 1
        
     return skin, non_skin
- 
-def calc_probability(skin, non_skin):
-    '''Probability function'''
+
+def is_skin_array(y_data: np.ndarray, threshold: int = 150) -> np.ndarray:
+    '''Vectorized `is_skin`: return a flat boolean array, True where the grountruth pixel is skin'''
+    return np.all(y_data > threshold, axis=-1).ravel()
+
+class pixel_sampler(object):
+    '''
+    Select the pixels counted from each training image, for fast approximate trainings
+
+    A `rate` fraction of the pixels of each image is kept, and at most `max_pixels`.
+    'stride' keeps evenly spaced pixels, 'random' a random subset seeded by `seed` and the
+    image path: samples do not depend on the order images are read in, nor on the workers
+    '''
+    def __init__(self, rate: float = 1.0, max_pixels: int = None, method: str = 'stride', seed: int = 0):
+        assert 0 < rate <= 1, 'Invalid sample rate: ' + str(rate)
+        assert max_pixels is None or max_pixels > 0, 'Invalid max pixels per image: ' + str(max_pixels)
+        assert method in samplings, 'Invalid sampling: ' + method
+        self.rate = rate
+        self.max_pixels = max_pixels
+        self.method = method
+        self.seed = seed
+
+    def is_full(self) -> bool:
+        return self.rate == 1 and self.max_pixels is None
+
+    def describe(self) -> dict:
+        '''Return the sampling parameters, None if every pixel is kept'''
+        if self.is_full():
+            return None
+        return {'rate': self.rate, 'max_pixels': self.max_pixels, 'method': self.method,
+                'seed': self.seed if self.method == 'random' else None}
+
+    def sample_size(self, pixels: int) -> int:
+        size = min(pixels, ceil(pixels * self.rate))
+        if self.max_pixels is not None:
+            size = min(size, self.max_pixels)
+        return size
+
+    def sample(self, im_data: np.ndarray, y_data: np.ndarray, key: str) -> tuple:
+        '''Return the sampled pixels of an image and of its groundtruth, as Nx3 arrays'''
+        im_data = im_data.reshape(-1, 3)
+        y_data = y_data.reshape(-1, 3)
+        pixels = im_data.shape[0]
+        size = self.sample_size(pixels)
+        if size == pixels:
+            return im_data, y_data
+        # same pairing as train_data(): pixel i of the image goes with pixel i of the grountruth
+        if y_data.shape[0] < pixels:
+            raise IndexError('Grountruth has less pixels than the image')
+
+        if self.method == 'stride':
+            sel = np.arange(size, dtype=np.int64) * pixels // size
+        else:
+            rng = np.random.default_rng([self.seed, zlib.crc32(key.encode())])
+            sel = np.sort(rng.choice(pixels, size, replace=False))
+        return im_data[sel], y_data[sel]
+
+def add_counts(hist: np.ndarray, idx: np.ndarray):
+    '''Increment the flattened histogram `hist` once for every index in `idx`'''
+    keys, counts = count_indexes(idx, hist.size)
+    hist[keys] += counts.astype(hist.dtype)
+
+def label_pixels(im_data: np.ndarray, y_data: np.ndarray, bits: int = default_bits,
+                 space: str = default_space) -> tuple:
+    '''Return the LUT index of each pixel of an image, and whether the grountruth labels it as skin'''
+    idx = colour_index(im_data, bits, space)
+    y_skin = is_skin_array(y_data)
+    # same pairing as train_data(): pixel i of the image goes with pixel i of the grountruth
+    if y_skin.size < idx.size:
+        raise IndexError('Grountruth has less pixels than the image')
+    return idx, y_skin[:idx.size]
+
+def train_data_array(im_data: np.ndarray, y_data: np.ndarray, skin, non_skin,
+                     space: str = default_space):
+    '''
+    Vectorized `train_data`: add a whole image to the 3-dimensional histograms at once
+
+    Colours are converted to the colour space `space`, and quantized to the size of the histograms
+    '''
+    idx, y_skin = label_pixels(im_data, y_data, lut_bits(skin.size, space), space)
+
+    # reshape() returns views, so counts land in the 3D histograms
+    add_counts(skin.reshape(-1), idx[y_skin])
+    add_counts(non_skin.reshape(-1), idx[~y_skin])
+    return skin, non_skin
+
+def image_counts(im_data: np.ndarray, y_data: np.ndarray, bits: int = default_bits,
+                 space: str = default_space) -> tuple:
+    '''
+    Return the colour counts of an image as sparse histograms:
+    (skin keys, skin counts, non skin keys, non skin counts)
+    '''
+    idx, y_skin = label_pixels(im_data, y_data, bits, space)
+    size = lut_length(bits, space)
+    return (*count_indexes(idx[y_skin], size), *count_indexes(idx[~y_skin], size))
+
+def add_image_counts(skin, non_skin, counts: tuple):
+    '''Add the sparse histograms returned by `image_counts` to the histograms of a model'''
+    skin.reshape(-1)[counts[0]] += counts[1].astype(skin.dtype)
+    non_skin.reshape(-1)[counts[2]] += counts[3].astype(non_skin.dtype)
+
+def calc_probability(skin, non_skin, dtype=np.float64) -> np.ndarray:
+    '''
+    Probability function
+
+    Return a flat LUT, computed a block at a time in float64 and stored as `dtype`:
+    no full-size temporary array is allocated
+    '''
     # ex: probability[10][20][30] = skin[10][20][30]/(skin[10][20][30] + non_skin[10][20][30])
-    return list(skin / (non_skin + skin))
+    skin = skin.reshape(-1)
+    non_skin = non_skin.reshape(-1)
+    probability = np.empty(skin.size, dtype=dtype)
+    with np.errstate(invalid='ignore'):
+        for start in range(0, skin.size, probability_block):
+            block = slice(start, start + probability_block)
+            total = non_skin[block].astype(np.float64)
+            total += skin[block]
+            np.divide(skin[block], total, out=probability[block], casting='same_kind')
+    return probability
 
 def data(probability):  ## just a function to make list of rgb and prob
-    '''Return a list of tuples (R,G,B,p) where p is the probability assigned to the RGB triplet'''
-    arr = []
-    
+    '''Yield tuples (R,G,B,p) where p is the probability assigned to the RGB triplet'''
+    probability = probability.reshape(256, 256, 256)
     for r in tqdm(range(256)):
         for g in range(256):
-            for b in range(256):
-                arr.append((r, g, b, probability[r][g][b])) # Nan on CSV if probability is None
-    
-    return arr
+            for b, p in enumerate(probability[r, g].tolist()):
+                yield (r, g, b, p) # Nan on CSV if probability is None
 
 def create_csv(probability, filename):
     '''Create model CSV file'''
@@ -64,21 +217,447 @@ def create_csv(probability, filename):
         writer.writerows(data(probability))
     info('Training Completed')
 
-def do_training(image_paths, out):
-    # 3D histograms which represent training data
-    skin = np.zeros((256,256,256)) 
-    non_skin = np.zeros((256,256,256))    
-    
-    info('Reading training images...')
+# Shared memory segment holding the partial counts of the current training worker
+worker_counts = None
+# Size and colour space of the histograms of the current training worker
+worker_size = lut_size
+worker_space = default_space
+# Pixels counted by the current training worker
+worker_pixels = 0
+# Partial counts generation of the current training worker, see `train_pool.reduce`
+worker_generation = 0
+# Pixel sampler of the current training worker
+worker_sampler = None
+
+def init_train_worker(segments: Queue, size: int, space: str, sampler: pixel_sampler = None):
+    '''Pool initializer: take ownership of one of the shared memory segments'''
+    global worker_counts, worker_size, worker_space, worker_sampler
+    worker_counts = shared_memory.SharedMemory(name=segments.get())
+    worker_size = size
+    worker_space = space
+    worker_sampler = sampler
+
+def train_shard(image_paths: list, generation: int = 0) -> int:
+    '''Add a shard of training images to the partial counts of the worker, return the shard size'''
+    global worker_pixels, worker_generation
+    # partial counts were reduced and zeroed since the last shard
+    if generation != worker_generation:
+        worker_pixels = 0
+        worker_generation = generation
+    # views over shared memory, dropped at the end so the segment can be closed
+    counts = np.ndarray((2, worker_size), dtype=np.uint32, buffer=worker_counts.buf)
+    for i in image_paths:
+        im = read_image_array(os.path.abspath(i[0]))
+        y = read_image_array(os.path.abspath(i[1]))
+        if worker_sampler is not None:
+            im, y = worker_sampler.sample(im, y, image_key(i))
+
+        worker_pixels += im.size // 3
+        # rounds of `train_pool.count` are bounded by pixel count: uint32 partial counts cannot overflow
+        assert worker_pixels <= max_counts, 'Too many pixels per worker'
+        train_data_array(im, y, counts[0], counts[1], worker_space)
+    del counts
+    return len(image_paths)
+
+class train_pool(object):
+    '''
+    Pool of training processes, each counting into its own shared memory segment,
+    so that partial histograms are summed by the parent without pickling them
+
+    Processes and segments are created once and live for a whole training:
+    at each checkpoint, partial histograms are reduced into the histograms
+    of the parent and zeroed (see `count`). Close the pool to free the segments
+    '''
+    def __init__(self, workers: int, size: int, space: str = default_space, sampler: pixel_sampler = None):
+        self.size = size
+        self.segments = []
+        self.executor = None
+        # incremented each time partial histograms are zeroed
+        self.generation = 0
+        try:
+            nbytes = 2 * size * np.dtype(np.uint32).itemsize
+            names = Queue()
+            for _ in range(workers):
+                self.segments.append(shared_memory.SharedMemory(create=True, size=nbytes))
+                np.ndarray((2, size), dtype=np.uint32, buffer=self.segments[-1].buf)[:] = 0
+                names.put(self.segments[-1].name)
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_train_worker,
+                                                initargs=(names, size, space, sampler))
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def count(self, image_paths: list, skin, non_skin) -> tuple:
+        '''
+        Add the given images to the histograms, split in shards among the workers
+
+        Images are counted in rounds of at most `max_worker_pixels` pixels, each reduced
+        before the next one starts: the uint32 partial counts of a worker cannot overflow.
+        The histograms must be able to hold the counts of all the images
+        '''
+        progress_bar = tqdm(total=len(image_paths))
+        for round_paths in pixel_batches(image_paths, max_worker_pixels):
+            shards = [round_paths[i:i + shard_size] for i in range(0, len(round_paths), shard_size)]
+            futures = [self.executor.submit(train_shard, shard, self.generation) for shard in shards]
+            for future in as_completed(futures):
+                progress_bar.update(future.result())
+            self.reduce(skin, non_skin)
+        progress_bar.close()
+        return skin, non_skin
+
+    def reduce(self, skin, non_skin):
+        '''Add the partial histograms to the given ones, and zero them: workers are idle'''
+        for segment in self.segments:
+            counts = np.ndarray((2, self.size), dtype=np.uint32, buffer=segment.buf)
+            skin.reshape(-1)[:] += counts[0]
+            non_skin.reshape(-1)[:] += counts[1]
+            counts[:] = 0
+            del counts
+        self.generation += 1
+
+    def close(self):
+        '''Stop the workers, then free the shared memory segments'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+def pixel_batches(image_paths: list, max_pixels: int) -> list:
+    '''Split images into consecutive batches of at most `max_pixels` pixels, read from their headers'''
+    batches = [[]]
+    batch_pixels = 0
+    for i in image_paths:
+        pixels = int(np.prod(read_image_size(i[0])))
+        if batches[-1] and batch_pixels + pixels > max_pixels:
+            batches.append([])
+            batch_pixels = 0
+        batches[-1].append(i)
+        batch_pixels += pixels
+    return [b for b in batches if b]
+
+def count_parallel(image_paths, workers: int, skin, non_skin, space: str = default_space,
+                   sampler: pixel_sampler = None):
+    '''Add the given images to the histograms using a pool of processes (see `train_pool`)'''
+    with train_pool(workers, skin.size, space, sampler) as pool:
+        return pool.count(image_paths, skin, non_skin)
+
+def peak_memory() -> float:
+    '''Return the peak resident set size in MB of this process, or of its biggest child process'''
+    if resource is None:
+        # not available on Windows: report the current resident set size
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    # ru_maxrss is in KB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+def count_images(image_paths, skin, non_skin, engine: str = 'numpy', workers: int = 1,
+                 space: str = default_space, sampler: pixel_sampler = None, pool: train_pool = None):
+    '''
+    Add the given images to the histograms, only the pixels selected by `sampler` if given
+
+    With more than one worker, images are counted by `pool` (a new pool if None)
+    '''
+    if pool is not None:
+        return pool.count(image_paths, skin, non_skin)
+    if workers > 1:
+        return count_parallel(image_paths, workers, skin, non_skin, space, sampler)
+
     for i in tqdm(image_paths):
         im_abspath = os.path.abspath(i[0])
         y_abspath = os.path.abspath(i[1])
 
-        im = read_image(im_abspath) # storing the pixels of actual picture..
-        y = read_image(y_abspath) # storing the pixels of mask picture..
-        skin, non_skin = train_data(im, y, skin, non_skin)
+        if engine == 'numpy':
+            im = read_image_array(im_abspath)
+            y = read_image_array(y_abspath)
+            if sampler is not None:
+                im, y = sampler.sample(im, y, image_key(i))
+            skin, non_skin = train_data_array(im, y, skin, non_skin, space)
+        else:
+            im = read_image(im_abspath) # storing the pixels of actual picture..
+            y = read_image(y_abspath) # storing the pixels of mask picture..
+            skin, non_skin = train_data(im, y, skin, non_skin)
+    return skin, non_skin
+
+def sampling_error(skin, non_skin, fraction: float, threshold: float = default_threshold) -> dict:
+    '''
+    Estimate how far the probabilities of a model trained on a `fraction` of the pixels
+    are from the ones of the model trained on every pixel
+
+    The error of each colour is the half-width of the confidence interval of its probability:
+    binomial standard error, with finite population correction. Return its maximum over
+    the colours counted, its mean over the pixels counted, and the share of pixels whose
+    colour is so close to the threshold that its decision may change
+    '''
+    keys, skin, non_skin = sparse_counts(skin, non_skin)
+    skin = skin.astype(np.float64)
+    non_skin = non_skin.astype(np.float64)
+    total = skin + non_skin
+    # smoothed variance, so that colours counted as skin or non skin only have an error too
+    variance = (skin + 1) * (non_skin + 1) / ((total + 2) ** 2 * total) * (1 - fraction)
+    error = confidence_z * np.sqrt(variance)
+    uncertain = np.abs(skin / total - threshold) < error
+    return {'colours': int(keys.size), 'max': float(error.max(initial=0)),
+            'mean': float(np.average(error, weights=total)) if keys.size else 0.0,
+            'uncertain': float(total[uncertain].sum() / total.sum()) if keys.size else 0.0}
+
+def lut_deviation(probability: np.ndarray, reference: np.ndarray,
+                  threshold: float = default_threshold) -> dict:
+    '''
+    Compare the probabilities of a model with the ones of a reference model:
+    absolute differences over the colours populated in both, colours with a different
+    decision, and colours of the reference never seen by the model
+    '''
+    assert probability.size == reference.size, 'Reference model has a different size'
+    probability = probability.reshape(-1)
+    reference = reference.reshape(-1)
+    populated = ~np.isnan(reference)
+    both = populated & ~np.isnan(probability)
+    diff = np.abs(probability[both].astype(np.float64) - reference[both])
+    # NaN probabilities (colours never seen in training) are skin
+    flipped = below_threshold(probability, threshold) != below_threshold(reference, threshold)
+    return {'colours': int(both.sum()), 'max': float(diff.max(initial=0)),
+            'mean': float(diff.mean()) if diff.size else 0.0,
+            'flipped': int(flipped.sum()), 'unseen': int((populated & ~both).sum())}
+
+def do_training(image_paths, out, engine: str = 'numpy', dataset: str = None, workers: int = 1,
+                update: bool = False, bits: int = default_bits, space: str = default_space,
+                sampler: pixel_sampler = None, reference: str = None):
+    '''
+    Train a model over the given images and save it to `out`
+
+    `engine` is either 'numpy' (vectorized, default) or 'python' (pixel by pixel).
+    Both produce the same model file
+
+    With more than one worker, images are split among a pool of processes (numpy engine)
+
+    Count histograms are saved next to the model every `checkpoint_images` images.
+    With `update`, only images which are not counted yet are read: this resumes
+    interrupted trainings, and adds new images to a trained model
+
+    With less than 8 `bits`, each channel is quantized to 2^bits levels (numpy engine)
+
+    Histograms are in the colour space `space` (numpy engine): 3D for 'rgb', 'ycbcr'
+    and 'hsv', 2D for the chrominance-only ones (eg. 'cbcr')
+
+    With a `sampler`, only some pixels of each image are counted (numpy engine), and the
+    estimated error of the probabilities is logged. If the `reference` model file
+    is trained on every pixel, the actual deviation from it is logged too
+
+    The model format is deduced from the `out` extension: native (.npy), sparse (.npz) or CSV.
+    CSV models are RGB and not quantized
+    '''
+    assert engine in engines, 'Invalid training engine: ' + engine
+    assert space in colour_spaces, 'Invalid colour space: ' + space
+    assert workers == 1 or engine == 'numpy', 'Parallel training requires the numpy engine'
+    assert (bits, space) == (default_bits, default_space) or engine == 'numpy', \
+        'Quantized and non-RGB training require the numpy engine'
+    assert (bits, space) == (default_bits, default_space) or out.endswith((native_ext, sparse_ext)), \
+        'CSV models cannot be quantized, nor in other colour spaces'
+    if sampler is not None and sampler.is_full():
+        sampler = None
+    assert sampler is None or engine == 'numpy', 'Pixel sampling requires the numpy engine'
+    sampling = sampler.describe() if sampler is not None else None
+    if reference is not None and sampler is None:
+        warning('A reference model is only compared with sampled trainings: ignoring ' + reference)
+    # checked before counting, not to lose the training
+    assert reference is None or sampler is None or model_layout(reference) == (bits, space), \
+        reference_mismatch(reference, bits, space)
+
+    # 3D histograms which represent training data (2D for chrominance-only colour spaces)
+    shape = (1 << bits,) * colour_spaces[space]
+    skin = np.zeros(shape, dtype=np.uint32)
+    non_skin = np.zeros(shape, dtype=np.uint32)
+    # images already counted into the histograms, with their hashes
+    counted = {}
+
+    info('Hashing training images...')
+    hashes = {image_key(i): hash_image(i) for i in image_paths}
+    saved = load_counts(out, bits, space, sampling) if update else None
+    if saved is not None:
+        if all(hashes.get(k) == h for k, h in saved[2].items()):
+            skin = saved[0].reshape(skin.shape)
+            non_skin = saved[1].reshape(non_skin.shape)
+            counted = saved[2]
+        else:
+            # counts of changed or removed images cannot be taken back
+            warning('Counted images were changed or removed, training from scratch')
+    todo = [i for i in image_paths if image_key(i) not in counted]
+    info(f'Images already counted: {len(counted)}, to count: {len(todo)}')
+
+    # no colour can be counted more times than the pixels counted
+    counted_pixels = int(skin.sum(dtype=np.uint64)) + int(non_skin.sum(dtype=np.uint64))
+    pixels = counted_pixels
+    # pixels of the images read by this training
+    read_pixels = 0
+
+    info('Reading training images...')
+    # the same workers count every checkpoint
+    pool = train_pool(workers, skin.size, space, sampler) if workers > 1 and todo else None
+    try:
+        for start in range(0, len(todo), checkpoint_images):
+            batch = todo[start:start + checkpoint_images]
+            batch_pixels = sum(int(np.prod(read_image_size(i[0]))) for i in batch)
+            pixels += batch_pixels
+            read_pixels += batch_pixels
+            if pixels > max_counts and skin.dtype != np.uint64:
+                info('Too many pixels for uint32 histograms, switching to uint64')
+                skin = skin.astype(np.uint64)
+                non_skin = non_skin.astype(np.uint64)
+            skin, non_skin = count_images(batch, skin, non_skin, engine=engine, workers=workers,
+                                          space=space, sampler=sampler, pool=pool)
+            counted.update({image_key(i): hashes[image_key(i)] for i in batch})
+            save_counts(out, skin, non_skin, counted, space, sampling)
+    finally:
+        if pool is not None:
+            pool.close()
     
-    probability = calc_probability(skin, non_skin)
+    # the reference is read before saving: it may be the model being replaced
+    deviation = None
+    if sampler is not None and read_pixels > 0 and reference is not None:
+        deviation = lut_deviation(calc_probability(skin, non_skin, dtype=np.float32),
+                                  load_model(reference, mmap=False))
+    save_trained(skin, non_skin, out, dataset=dataset, images=len(counted), space=space)
+    if sampler is not None and read_pixels > 0:
+        report_sampling(skin, non_skin, counted_pixels, read_pixels, reference, deviation)
+    info(f'Peak memory: {peak_memory():.0f} MB')
+
+def reference_mismatch(reference: str, bits: int, space: str) -> str:
+    '''Return the message of a reference model not comparable with a model of the given bits and colour space'''
+    ref_bits, ref_space = model_layout(reference)
+    return f'Reference model {reference} is {ref_space} with {ref_bits} bits per channel, not {space} with {bits}'
+
+def report_sampling(skin, non_skin, counted_pixels: int, read_pixels: int, reference: str = None,
+                    deviation: dict = None):
+    '''
+    Log the pixels sampled by a training, and how far its model is from a model trained on every pixel
+
+    `deviation` from the `reference` model is the one returned by `lut_deviation`
+    '''
+    sampled = int(skin.sum(dtype=np.uint64)) + int(non_skin.sum(dtype=np.uint64)) - counted_pixels
+    fraction = sampled / read_pixels
+    info(f'Sampled {sampled} pixels out of {read_pixels} ({fraction:.2%})')
 
+    error = sampling_error(skin, non_skin, fraction)
+    info(f'Estimated probability error ({confidence_z} sigma) over {error["colours"]} colours: '
+         f'max {error["max"]:.4f}, mean {error["mean"]:.4f} per pixel; '
+         f'{error["uncertain"]:.2%} of the pixels may change decision')
+
+    if deviation is not None:
+        info(f'Deviation from {reference} over {deviation["colours"]} colours: '
+             f'max {deviation["max"]:.4f}, mean {deviation["mean"]:.4f}; '
+             f'{deviation["flipped"]} colours change decision, {deviation["unseen"]} colours never sampled')
+
+def save_trained(skin, non_skin, out: str, dataset: str = None, images: int = None,
+                 space: str = default_space, provenance: list = None):
+    '''Save a model from its histograms, in the format given by the `out` extension'''
     info('Saving training data...')
-    create_csv(probability, out) # creating CSV from that probabilty and rgb
+    if out.endswith(native_ext):
+        probability = calc_probability(skin, non_skin, dtype=np.float32)
+        save_model(probability, out, dataset=dataset, images=images, space=space, provenance=provenance)
+        info('Training Completed')
+    elif out.endswith(sparse_ext):
+        save_sparse_model(skin, non_skin, out, dataset=dataset, images=images, space=space,
+                          provenance=provenance)
+        info('Training Completed')
+    else:
+        # CSV models keep float64 probabilities
+        probability = calc_probability(skin, non_skin)
+        create_csv(probability, out) # creating CSV from that probabilty and rgb
+
+def do_training_all(trainings: list, bits: int = default_bits, space: str = default_space):
+    '''
+    Train many models in a single pass over their images
+
+    `trainings` is a list of (image paths, out, dataset) as given to `do_training`.
+    A routing table maps each unique (image, grountruth) pair to the models including it:
+    each pair is decoded once, and its counts are added to all of them
+    '''
+    assert space in colour_spaces, 'Invalid colour space: ' + space
+    for _, out, _ in trainings:
+        assert (bits, space) == (default_bits, default_space) or out.endswith((native_ext, sparse_ext)), \
+            'CSV models cannot be quantized, nor in other colour spaces'
+
+    # routing table: (image, grountruth) -> indexes of the models including it
+    routes = {}
+    for m, (image_paths, _, _) in enumerate(trainings):
+        for i in image_paths:
+            routes.setdefault((os.path.normpath(i[0]), os.path.normpath(i[1])), []).append(m)
+    total = sum(len(t[0]) for t in trainings)
+    info(f'Training {len(trainings)} models: {len(routes)} unique images out of {total}')
+
+    shape = (1 << bits,) * colour_spaces[space]
+    hists = [[np.zeros(shape, dtype=np.uint32), np.zeros(shape, dtype=np.uint32)] for _ in trainings]
+    pixels = [0] * len(trainings)
+    counted = [{} for _ in trainings]
+
+    info('Reading training images...')
+    for pair, models in tqdm(routes.items()):
+        im = read_image_array(os.path.abspath(pair[0]))
+        y = read_image_array(os.path.abspath(pair[1]))
+        counts = image_counts(im, y, bits, space)
+        image_hash = hash_image(pair)
+
+        for m in models:
+            pixels[m] += im.shape[0] * im.shape[1]
+            if pixels[m] > max_counts and hists[m][0].dtype != np.uint64:
+                hists[m] = [h.astype(np.uint64) for h in hists[m]]
+            add_image_counts(*hists[m], counts)
+            counted[m][image_key(pair)] = image_hash
+
+    for m, (_, out, dataset) in enumerate(trainings):
+        info(f'Saving model {out}')
+        save_counts(out, *hists[m], counted[m], space)
+        save_trained(*hists[m], out, dataset=dataset, images=len(counted[m]), space=space)
+    info(f'Peak memory: {peak_memory():.0f} MB')
+
+def combine_models(model_files: list, weights: list, out: str):
+    '''
+    Build a model from the weighted sum of the count histograms of other models
+
+    Negative weights subtract models: negative counts are clipped to zero.
+    With integer weights counts stay integers. Models must share bits and colour space.
+    The header of the new model records the models it is built from
+    '''
+    assert len(model_files) == len(weights), 'There must be a weight for each model'
+    integer = all(float(w).is_integer() for w in weights)
+
+    skin = non_skin = None
+    provenance = []
+    for filename, weight in zip(model_files, weights):
+        m_skin, m_non_skin, source = load_model_counts(filename)
+        if skin is None:
+            skin = np.zeros(m_skin.size)
+            non_skin = np.zeros(m_skin.size)
+            bits, space = source['bits'], source['colour_space']
+        assert (source['bits'], source['colour_space']) == (bits, space), \
+            critical(f'Models cannot be combined: {filename} has different bits or colour space')
+        info(f'Adding {source["file"]} with weight {weight}')
+        skin += weight * m_skin.astype(np.float64)
+        non_skin += weight * m_non_skin.astype(np.float64)
+        provenance.append({'file': os.path.basename(source['file']), 'hash': source['hash'], 'weight': weight})
+
+    negative = np.count_nonzero((skin < 0) | (non_skin < 0))
+    if negative > 0:
+        warning(f'{negative} colours have negative counts: they are clipped to zero')
+        np.maximum(skin, 0, out=skin)
+        np.maximum(non_skin, 0, out=non_skin)
+    if integer:
+        dtype = np.uint32 if max(skin.max(), non_skin.max()) <= max_counts else np.uint64
+        skin = skin.astype(dtype)
+        non_skin = non_skin.astype(dtype)
+
+    assert (bits, space) == (default_bits, default_space) or out.endswith((native_ext, sparse_ext)), \
+        'CSV models cannot be quantized, nor in other colour spaces'
+    if not out.endswith((native_ext, sparse_ext)):
+        warning('CSV models have no header: provenance is not recorded')
+    save_trained(skin, non_skin, out, space=space, provenance=provenance)
+    return provenance
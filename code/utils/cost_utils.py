@@ -0,0 +1,66 @@
+import json
+import os
+
+import psutil
+from PIL import Image
+
+from utils.db_utils import models_dir
+from utils.logmanager import *
+from utils.skin_dataset import skin_dataset
+
+# Inference cost model: the time spent on an image scales with its pixel count
+# Image sizes are read from file headers only, and cached per dataset
+# in the models directory, leaving dataset directories untouched
+
+
+def determine_workers(workers: int) -> int:
+    '''
+    If workers == -1, number of workers is equal to the
+    number of system's physical cores
+    '''
+    if workers == -1:
+        workers = psutil.cpu_count(logical=False)
+    return workers
+
+def sizes_filename(db: skin_dataset) -> str:
+    return os.path.join(models_dir, f'{db.name}.image_sizes.json')
+
+def read_image_size(path: str) -> tuple:
+    '''Return (width, height) of an image by reading its header, without decoding pixels'''
+    with Image.open(path) as im:
+        return im.size
+
+def get_megapixels(db: skin_dataset, image_paths: list) -> list:
+    '''
+    Return the size in megapixels of each original image in `image_paths`
+
+    Sizes are cached by dataset name (see `sizes_filename`), and read again
+    only for images modified since they were cached
+    '''
+    cache_file = sizes_filename(db)
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    megapixels = []
+    updated = False
+    for i in image_paths:
+        path = os.path.normpath(i[0])
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if path not in cache or cache[path][0] != mtime:
+                cache[path] = (mtime, *read_image_size(path))
+                updated = True
+            _, width, height = cache[path]
+            megapixels.append(width * height / 1e6)
+        except Exception:
+            # the prediction will report it, count it as free
+            warning(f'Cannot read image size: {path}')
+            megapixels.append(0)
+
+    if updated:
+        os.makedirs(models_dir, exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+    return megapixels
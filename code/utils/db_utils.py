@@ -5,6 +5,7 @@ import cv2
 from utils.abd import abd
 from utils.ECU import ECU
 from utils.HGR import HGR
+from utils.logmanager import *
 from utils.Pratheepan import Pratheepan
 from utils.Schmugge import Schmugge, dark, light, medium
 from utils.skin_dataset import skin_dataset
@@ -13,6 +14,8 @@ from utils.VPU import VPU
 
 # NOTE: method-specific (probabilistic)
 models_dir = os.path.join('..', 'models')
+# Model file formats, in order of preference
+model_formats = ('npy', 'npz', 'csv')
 
 skin_databases_skintones = (dark(), medium(), light())
 skin_databases = (ECU(), Schmugge(), HGR(), dark(), medium(), light(),
@@ -20,8 +23,40 @@ skin_databases = (ECU(), Schmugge(), HGR(), dark(), medium(), light(),
 
 
 # NOTE: method-specific (probabilistic)
-def get_model_filename(database: skin_dataset) -> str:
-    return os.path.join(models_dir, database.name + '.csv')
+def get_model_filename(database: skin_dataset, format: str = None) -> str:
+    '''
+    Return the model filename of a dataset in the given format
+
+    If format is None, return the most recently written existing model file
+    (by order of preference if written at the same time), or the CSV one if there is none:
+    a model retrained in another format is not shadowed by a stale one.
+    The choice is logged when many formats exist
+    '''
+    if format is None:
+        existing = get_model_files(database)
+        if not existing:
+            return get_model_filename(database, 'csv')
+        # max() keeps the first one of equal keys
+        filename = max(existing, key=os.path.getmtime)
+        if len(existing) > 1:
+            info(f'Using model {filename}, the most recent of: {", ".join(existing)}')
+        return filename
+    return os.path.join(models_dir, f'{database.name}.{format}')
+
+def get_model_files(database: skin_dataset) -> list:
+    '''Return the existing model files of a dataset, by order of preference'''
+    filenames = [get_model_filename(database, format) for format in model_formats]
+    return [x for x in filenames if os.path.isfile(x)]
+
+def resolve_model(name: str = None, filename: str = None) -> tuple:
+    '''
+    Return (name, filename) of the model of a dataset, or of a model file
+    (eg. a merged model, named after its file: ../models/ECU+HGR.npz is ECU+HGR)
+    '''
+    assert (name is None) != (filename is None), 'Choose either the model of a dataset or a model file'
+    if filename is None:
+        return name, get_model_filename(get_db_by_name(name))
+    return os.path.splitext(os.path.basename(filename))[0], filename
 
 def get_db_by_name(name: str) -> skin_dataset:
     for database in skin_databases:
@@ -33,14 +68,25 @@ def get_db_by_name(name: str) -> skin_dataset:
 def skin_databases_names(db_list: list = skin_databases) -> list:
     return [x.name for x in db_list]
 
+def has_train_split(database: skin_dataset) -> bool:
+    '''Return True if the dataset CSV file has training or validation lines'''
+    if not os.path.isfile(database.csv):
+        return False
+    notes = (database.nt_training, database.nt_validation)
+    for row in database.read_csv():
+        fields = database.split_csv_fields(row)
+        if len(fields) > 2 and fields[2] in notes:
+            return True
+    return False
+
 def get_trainable() -> list:
     '''Return the list of datasets with already defined splits'''
-    result = [x for x in skin_databases if len(x.get_train_paths()) > 0]
+    result = [x for x in skin_databases if has_train_split(x)]
     return result
 
 def get_models() -> list:
     '''Return the list of skin datasets having a trained model file'''
-    result = [x for x in skin_databases if os.path.isfile(get_model_filename(x))]
+    result = [x for x in skin_databases if get_model_files(x)]
     return result
 
 def get_datasets() -> list:
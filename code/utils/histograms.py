@@ -0,0 +1,133 @@
+import json
+import os
+
+import numpy as np
+
+from utils.hash_utils import hash_file
+from utils.logmanager import *
+from utils.skin_model import (default_bits, default_space, dense_counts,
+                              lut_bits, lut_length, read_header, sparse_counts,
+                              sparse_ext)
+
+# Count histograms persisted next to each model, to train incrementally
+#   <model>.counts.npz compressed sparse skin and non_skin counts (see `sparse_counts`), as uint32
+#                      arrays (uint64 if a colour is counted more than 2^32-1 times), and their
+#                      manifest as a JSON string: images already counted, with the hashes of image
+#                      and groundtruth, the bits per channel and colour space of the histograms,
+#                      and how pixels were sampled if not all of them were counted
+# Counts and manifest are in the same file, so that a checkpoint is replaced at once.
+# Each format of a model has its own counts (eg. ECU.npy.counts.npz): models of the same
+# dataset in other formats may have other bits, colour space or sampling
+counts_ext = '.counts.npz'
+counts_dtype = np.uint32
+# Counting colours: a full-length bincount is cheaper than sorting
+# once there are more pixels than this fraction of the histogram length
+dense_count_fraction = 8
+
+
+def counts_filename(model_filename: str) -> str:
+    return model_filename + counts_ext
+
+def image_key(image_path: tuple) -> str:
+    '''Return the manifest key of an (image, groundtruth) pair'''
+    return os.path.normpath(image_path[0])
+
+def hash_image(image_path: tuple) -> str:
+    '''Return a hash of an (image, groundtruth) pair: it changes if any of the two files changes'''
+    return hash_file(image_path[0]) + hash_file(image_path[1])
+
+def count_indexes(idx: np.ndarray, size: int) -> tuple:
+    '''Return the indexes in `idx` (all below `size`) sorted and deduplicated, with their counts'''
+    if idx.size > size // dense_count_fraction:
+        # big images: a full-length bincount is cheaper than sorting
+        counts = np.bincount(idx, minlength=size)
+        keys = np.flatnonzero(counts)
+        return keys, counts[keys]
+    # small images: only touch the colours actually present
+    return np.unique(idx, return_counts=True)
+
+def save_counts(model_filename: str, skin, non_skin, images: dict, space: str = default_space,
+                sampling: dict = None):
+    '''
+    Save the count histograms of a model along with its manifest
+
+    `images` maps the key of each counted image to its hash,
+    `sampling` describes the pixels counted from each image (None: all of them).
+    The file is replaced atomically, so it can be used as a checkpoint
+    '''
+    manifest = {'images': images, 'bits': lut_bits(skin.size, space), 'colour_space': space}
+    if sampling is not None:
+        manifest['sampling'] = sampling
+
+    keys, skin, non_skin = sparse_counts(skin, non_skin)
+    counts = {'keys': keys, 'manifest': json.dumps(manifest, sort_keys = True)}
+    for name, hist in (('skin', skin), ('non_skin', non_skin)):
+        dtype = counts_dtype if hist.size == 0 or hist.max() <= np.iinfo(counts_dtype).max else np.uint64
+        counts[name] = hist.astype(dtype, copy=False)
+
+    filename = counts_filename(model_filename)
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **counts)
+    os.replace(filename + '.tmp', filename)
+
+def read_manifest(model_filename: str) -> dict:
+    '''Return the manifest of the counts saved by `save_counts`, None if there are none'''
+    if not os.path.isfile(counts_filename(model_filename)):
+        return None
+    with np.load(counts_filename(model_filename)) as counts:
+        if 'manifest' not in counts:
+            warning('Saved counts have no manifest: ' + counts_filename(model_filename))
+            return None
+        return json.loads(str(counts['manifest']))
+
+def load_counts(model_filename: str, bits: int = default_bits, space: str = default_space,
+                sampling: dict = None):
+    '''
+    Return (skin, non_skin, images) saved by `save_counts`, None if there are no saved counts
+    with the given bits per channel, colour space and sampling
+
+    Histograms are flat uint32 (or uint64) arrays
+    '''
+    manifest = read_manifest(model_filename)
+    if manifest is None:
+        return None
+
+    saved = (manifest.get('bits', default_bits), manifest.get('colour_space', default_space))
+    if saved != (bits, space):
+        warning(f'Saved counts are {saved[1]} with {saved[0]} bits per channel, not {space} with {bits}')
+        return None
+    if manifest.get('sampling') != sampling:
+        warning(f'Saved counts sampled pixels as {manifest.get("sampling")}, not as {sampling}')
+        return None
+
+    with np.load(counts_filename(model_filename)) as counts:
+        assert 'keys' in counts, critical('Invalid count histograms: ' + counts_filename(model_filename))
+        skin = dense_counts(counts['keys'], counts['skin'], lut_length(bits, space))
+        non_skin = dense_counts(counts['keys'], counts['non_skin'], lut_length(bits, space))
+    return skin, non_skin, manifest['images']
+
+def load_model_counts(model_filename: str) -> tuple:
+    '''
+    Return (skin, non_skin, source) with the flat count histograms of a model
+
+    Counts are read from the model file if it is sparse, from the counts
+    saved by training otherwise. `source` describes where they come from
+    '''
+    if model_filename.endswith(sparse_ext):
+        header = read_header(model_filename)
+        with np.load(model_filename) as model:
+            skin = dense_counts(model['keys'], model['skin'], header['size'])
+            non_skin = dense_counts(model['keys'], model['non_skin'], header['size'])
+        source = {'file': model_filename, 'hash': header['hash'],
+                  'colour_space': header.get('colour_space', default_space)}
+    else:
+        manifest = read_manifest(model_filename)
+        assert manifest is not None, critical('No counts saved for model: ' + model_filename)
+        space = manifest.get('colour_space', default_space)
+        skin, non_skin, _ = load_counts(model_filename, manifest.get('bits', default_bits), space,
+                                        manifest.get('sampling'))
+        source = {'file': counts_filename(model_filename),
+                  'hash': hash_file(counts_filename(model_filename)), 'colour_space': space}
+
+    source['bits'] = lut_bits(skin.size, source['colour_space'])
+    return skin, non_skin, source
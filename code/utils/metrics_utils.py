@@ -1,3 +1,4 @@
+import json
 import os
 from statistics import mean, pstdev
 
@@ -7,21 +8,82 @@ from PIL import Image
 from tqdm import tqdm
 
 from utils.logmanager import *
-
-
-def load_images(gt_path: str, pred_path: str, threshold: int = 128):
-    '''Load images as numpy boolean arrays'''
+from utils.skin_model import below_threshold, default_threshold
+
+# Probability maps saved as PNG have this text chunk, with the value of probability 1 (255 or 65535)
+probability_key = 'skin-probability'
+# Probability maps can also be saved as float32 .npy arrays (NaN: colour never seen in training)
+probability_ext = '.npy'
+# Measurements dumped by `measure eval --dump`, and by fused predictions
+dump_dir = os.path.join('..', 'dumps')
+dump_filename = os.path.join(dump_dir, 'metrics_{}_{}.json')
+
+
+def load_probability(pred_path: str):
+    '''Return the skin probability map of a prediction as a float array, None if the prediction is a mask'''
+    if pred_path.endswith(probability_ext):
+        return np.load(pred_path)
+    with Image.open(pred_path) as im:
+        scale = im.info.get(probability_key)
+        if scale is None:
+            return None
+        return np.asarray(im, dtype=np.float64) / float(scale)
+
+def load_groundtruth(gt_path: str, threshold: int = 128) -> np.ndarray:
+    '''Load a groundtruth as a numpy boolean array'''
     # Load as grayscale uint8
     gt_gray = np.array(Image.open(gt_path).convert('L'))
-    pred_gray = np.array(Image.open(pred_path).convert('L'))
     # Binarize and convert to bool
-    gt_bool = gt_gray > threshold
-    pred_bool = pred_gray > threshold
+    return gt_gray > threshold
+
+def load_images(gt_path: str, pred_path: str, threshold: int = 128,
+                p_threshold: float = default_threshold):
+    '''
+    Load images as numpy boolean arrays
+
+    Probability maps are binarized at the skin probability `p_threshold`, as models do
+    '''
+    gt_bool = load_groundtruth(gt_path, threshold)
+
+    probability = load_probability(pred_path)
+    if probability is None:
+        pred_gray = np.array(Image.open(pred_path).convert('L'))
+        pred_bool = pred_gray > threshold
+    else:
+        pred_bool = ~below_threshold(probability, p_threshold)
     return gt_bool, pred_bool
 
+def image_metrics(y_true: np.ndarray, y_pred: np.ndarray, metric_fns: list) -> dict:
+    '''
+    Return a dict with the score of each metric function, comparing
+    the groundtruth of an image to its prediction (both boolean arrays)
+
+    Medium-averaging metric functions get skipped as they cannot be computed on a single image
+    '''
+    idata = {}
+    # Calculate confusion matrix scores for current image
+    confmat = confmat_scores(y_true, y_pred)
+
+    # Calculate metrics for current image and add them to the dict structure
+    for metric_fn in metric_fns:
+        f_name = metric_fn.__name__
+        f_argcount = metric_fn.__code__.co_argcount # amount of argument in function definition
+
+        if f_name.endswith('_medium'): # is a medium-average metric, must not compute now
+            continue
+
+        # only one args: the metric only uses confusion matrix scores and is LUT-optimized
+        if f_argcount == 1:
+            idata[f_name] = metric_fn(confmat)
+        # two args: confusion matrix scores aren't enough
+        else:
+            idata[f_name] = metric_fn(y_true, y_pred)
+    return idata
+
 # MEDIUM AVERAGE: calculate average only of medium-scores (PRecision, REcall, SPecificity)
 # Note: y and p files must have the same filename
-def calc_metrics(gt_dir: str, pred_dir: str, metric_fns: list, threshold: int = 128) -> list:
+def calc_metrics(gt_dir: str, pred_dir: str, metric_fns: list, threshold: int = 128,
+                 p_threshold: float = default_threshold) -> list:
     '''
     Compute all the given metric functions over all images in a folder
     by considering a single image at a time and comparing
@@ -31,6 +93,8 @@ def calc_metrics(gt_dir: str, pred_dir: str, metric_fns: list, threshold: int =
     Each dict represents the metrics measurement on a single image
 
     Medium-averaging metric functions get skipped as they cannot be computed on a single image
+
+    Predictions which are probability maps are binarized at `p_threshold`
     '''
     out = []
 
@@ -38,7 +102,9 @@ def calc_metrics(gt_dir: str, pred_dir: str, metric_fns: list, threshold: int =
     for y_filename in tqdm(os.listdir(gt_dir)):
         y_path = os.path.join(gt_dir, y_filename)
         p_filename = os.path.splitext(y_filename)[0] + '.png'
-        p_path = os.path.join(pred_dir, p_filename) # pred are always PNG
+        p_path = os.path.join(pred_dir, p_filename) # pred are PNG, or npy probability maps
+        if not os.path.isfile(p_path):
+            p_path = os.path.splitext(p_path)[0] + probability_ext
 
         # Start adding current image data into a dict structure
         idata = {}
@@ -47,24 +113,8 @@ def calc_metrics(gt_dir: str, pred_dir: str, metric_fns: list, threshold: int =
 
         # Load images from paths and apply threshold to binarize
         # the skin probability maps obtained from predictions
-        y_true, y_pred = load_images(y_path, p_path, threshold)
-        # Calculate confusion matrix scores for current image
-        confmat = confmat_scores(y_true, y_pred)
-
-        # Calculate metrics for current image and add them to the dict structure
-        for metric_fn in metric_fns:
-            f_name = metric_fn.__name__
-            f_argcount = metric_fn.__code__.co_argcount # amount of argument in function definition
-
-            if f_name.endswith('_medium'): # is a medium-average metric, must not compute now
-                continue
-
-            # only one args: the metric only uses confusion matrix scores and is LUT-optimized
-            if f_argcount == 1:
-                idata[f_name] = metric_fn(confmat)
-            # two args: confusion matrix scores aren't enough
-            else:
-                idata[f_name] = metric_fn(y_true, y_pred)
+        y_true, y_pred = load_images(y_path, p_path, threshold, p_threshold)
+        idata.update(image_metrics(y_true, y_pred, metric_fns))
         
         # Update the final list with current image data
         out.append(idata)
@@ -157,6 +207,15 @@ def calc_mean_metrics(measurements_list: list, metric_fns: list, desc: str, meth
     
     return res
 
+def dump_metrics(name: str, avg: dict, singles: list):
+    '''Dump the average and single measurements of a predictions folder named `name`'''
+    os.makedirs(dump_dir, exist_ok=True)
+
+    with open(dump_filename.format(name, 'average'), 'w') as f:
+        json.dump(avg, f, sort_keys = True, indent = 4)
+    with open(dump_filename.format(name, 'singles'), 'w') as f:
+        json.dump(singles, f, sort_keys = True, indent = 4)
+
 def read_performance(perf_dir: str):
     '''Read inference time from performance benchmark files, and print it'''
     csv_sep = ','
@@ -0,0 +1,542 @@
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import pandas as pd
+import xxhash
+
+from utils.logmanager import *
+
+# Native model format
+#   <name>.npy   flat LUT of 256*256*256 skin probabilities, indexed by (r<<16)|(g<<8)|b
+#                (or quantized to 2^bits levels per channel, see `rgb_index`, or in
+#                another colour space, see `colour_index`)
+#   <name>.json  small header describing the LUT
+# Colours never seen in training have a NaN probability, exactly as in the CSV models
+native_ext = '.npy'
+header_ext = '.json'
+# Sparse model format
+#   <name>.npz   the colours seen in training as sorted LUT indexes (keys), with their
+#                skin and non_skin counts, and the header as a JSON string
+# Training data touches a small fraction of the colours: the file is much smaller,
+# and the counts make models mergeable
+sparse_ext = '.npz'
+format_version = 1
+lut_size = 256 * 256 * 256
+# Bits per channel of a full resolution LUT
+default_bits = 8
+# Colour spaces models can be trained in, with their number of channels
+# 2-channel spaces only look at chrominance: 'cbcr' (of YCbCr), 'hs' (of HSV),
+# 'rg' (normalized rg chromaticity r=R/(R+G+B), g=G/(R+G+B), scaled to 0-255)
+colour_spaces = {'rgb': 3, 'ycbcr': 3, 'hsv': 3, 'cbcr': 2, 'hs': 2, 'rg': 2}
+default_space = 'rgb'
+# Pixels having a skin probability >= threshold are predicted as skin
+default_threshold = 0.555555
+# Memory cap of the process-wide model cache
+cache_max_bytes = 1024 ** 3
+# Where models shared among processes are placed: RAM-backed on Linux
+shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def lut_length(bits: int = default_bits, space: str = default_space) -> int:
+    '''Return the size of a LUT quantizing each channel of the colour space to `bits` bits'''
+    return 1 << (colour_spaces[space] * bits)
+
+def lut_bits(size: int, space: str = default_space) -> int:
+    '''Return the bits per channel of a LUT of the given size'''
+    bits = (size.bit_length() - 1) // colour_spaces[space]
+    assert 1 <= bits <= 8 and size == lut_length(bits, space), f'Invalid LUT size: {size}'
+    return bits
+
+def below_threshold(probability: np.ndarray, threshold: float) -> np.ndarray:
+    '''
+    Return a boolean array, True where a skin probability is below the threshold: non skin
+
+    The threshold is compared as float64, as CSV models do: float32 probabilities compared
+    with a Python float are compared in float32, which can round a colour up to the threshold.
+    NaN probabilities (colours never seen in training) are not below any threshold: skin
+    '''
+    return probability < np.float64(threshold)
+
+def rgb_index(im_data: np.ndarray, bits: int = default_bits) -> np.ndarray:
+    '''
+    Pack each R,G,B triplet into the 24-bit index `(r<<16)|(g<<8)|b` of a flat LUT
+
+    With less than 8 bits, each channel is quantized to its `bits` most significant bits
+    and the index is `(r<<2*bits)|(g<<bits)|b`
+    '''
+    rgb = im_data.reshape(-1, 3).astype(np.uint32)
+    if bits != 8:
+        rgb >>= 8 - bits
+    return (rgb[:, 0] << (2 * bits)) | (rgb[:, 1] << bits) | rgb[:, 2]
+
+# cv2 conversion of each colour space, and the channels kept from its output, in index order
+space_conversions = {
+    'ycbcr': (cv2.COLOR_RGB2YCrCb, [0, 2, 1]),
+    'cbcr': (cv2.COLOR_RGB2YCrCb, [2, 1]),
+    # full range hue: 0-255 instead of 0-179
+    'hsv': (cv2.COLOR_RGB2HSV_FULL, [0, 1, 2]),
+    'hs': (cv2.COLOR_RGB2HSV_FULL, [0, 1]),
+}
+
+def convert_channels(im_data: np.ndarray, space: str) -> list:
+    '''Return the pixels of an RGB image as a list of flat uint8 arrays, one per channel of the colour space'''
+    # one row image: cv2 is much slower on Nx1 images
+    rgb = np.ascontiguousarray(im_data, dtype=np.uint8).reshape(1, -1, 3)
+    if space == 'rgb':
+        colours = rgb[0]
+        return [colours[:, c] for c in range(3)]
+    if space in space_conversions:
+        code, channels = space_conversions[space]
+        colours = cv2.cvtColor(rgb, code)[0]
+        return [colours[:, c] for c in channels]
+    if space == 'rg':
+        rgb = rgb[0]
+        total = rgb.sum(axis=1, dtype=np.float32)
+        # black has no chromaticity: count it as r = g = 0
+        np.maximum(total, 1, out=total)
+        channels = []
+        for c in range(2):
+            # rounded to nearest: float32 is exact enough for every RGB triplet
+            channel = rgb[:, c] * np.float32(255)
+            channel /= total
+            channel += np.float32(0.5)
+            channels.append(channel.astype(np.uint8))
+        return channels
+    raise ValueError('Invalid colour space: ' + space)
+
+def convert_colours(im_data: np.ndarray, space: str) -> np.ndarray:
+    '''Return the pixels of an RGB image as a Nxchannels uint8 array of the given colour space'''
+    return np.stack(convert_channels(im_data, space), axis=1)
+
+def colour_index(im_data: np.ndarray, bits: int = default_bits, space: str = default_space) -> np.ndarray:
+    '''
+    Pack the pixels of an RGB image into the indexes of a flat LUT of the given colour space
+
+    Channels are packed as in `rgb_index`: the first one in the most significant bits
+    '''
+    if space == 'rgb':
+        return rgb_index(im_data, bits)
+
+    idx = None
+    for channel in convert_channels(im_data, space):
+        channel = channel.astype(np.uint32)
+        if bits != 8:
+            channel >>= 8 - bits
+        if idx is None:
+            idx = channel
+        else:
+            idx <<= bits
+            idx |= channel
+    return idx
+
+def header_filename(filename: str) -> str:
+    '''Return the header filename of a native model file'''
+    return os.path.splitext(filename)[0] + header_ext
+
+def hash_lut(lut: np.ndarray) -> str:
+    '''Return a hash hexdigest representing the LUT content'''
+    return xxhash.xxh3_64(np.ascontiguousarray(lut).data).hexdigest()
+
+def read_header(filename: str) -> dict:
+    '''Return the header of a native or sparse model file'''
+    if filename.endswith(sparse_ext):
+        with np.load(filename) as model:
+            return json.loads(str(model['header']))
+    with open(header_filename(filename)) as f:
+        return json.load(f)
+
+def sparse_counts(skin, non_skin) -> tuple:
+    '''Return (keys, skin counts, non_skin counts) of the colours counted at least once'''
+    skin = skin.reshape(-1)
+    non_skin = non_skin.reshape(-1)
+    keys = np.flatnonzero((skin != 0) | (non_skin != 0)).astype(np.uint32)
+    return keys, skin[keys], non_skin[keys]
+
+def dense_counts(keys: np.ndarray, counts: np.ndarray, size: int = lut_size) -> np.ndarray:
+    '''Return the flat histogram of sparse counts'''
+    hist = np.zeros(size, dtype=counts.dtype)
+    hist[keys] = counts
+    return hist
+
+def save_sparse_model(skin, non_skin, filename: str, dataset: str = None, images: int = None,
+                      space: str = default_space, provenance: list = None) -> dict:
+    '''
+    Save the count histograms of a model as a sparse model file
+
+    `provenance` lists the models a derived model is built from
+
+    Return the header written into the model
+    '''
+    size = skin.size
+    keys, skin, non_skin = sparse_counts(skin, non_skin)
+
+    if dataset is None:
+        dataset = os.path.splitext(os.path.basename(filename))[0]
+
+    hash = xxhash.xxh3_64()
+    for a in (keys, skin, non_skin):
+        hash.update(np.ascontiguousarray(a).data)
+    header = {
+        'version': format_version,
+        'dataset': dataset,
+        'images': images,
+        'dtype': 'sparse',
+        'size': size,
+        'bits': lut_bits(size, space),
+        'colour_space': space,
+        'colours': int(keys.size),
+        'hash': hash.hexdigest(),
+    }
+    if provenance is not None:
+        header['provenance'] = provenance
+
+    np.savez_compressed(filename, keys=keys, skin=skin, non_skin=non_skin,
+                        header=json.dumps(header, sort_keys = True))
+    return header
+
+def load_sparse_model(filename: str) -> tuple:
+    '''
+    Return the colours seen in training as sorted LUT indexes, and their float64 probabilities
+
+    Dense models have no counts: the colours seen in training are the ones having a probability
+    '''
+    if not filename.endswith(sparse_ext):
+        lut = load_model(filename)
+        keys = np.flatnonzero(~np.isnan(lut)).astype(np.uint32)
+        return keys, lut[keys].astype(np.float64)
+
+    assert os.path.isfile(filename), critical('Model file not existing: ' + filename)
+    info('Reading sparse model...')
+    with np.load(filename) as model:
+        keys = model['keys']
+        skin = model['skin']
+        total = model['non_skin'] + skin.astype(np.float64)
+    return keys, skin / total
+
+def save_model(probability, filename: str, dataset: str = None, images: int = None,
+               dtype: str = 'float32', space: str = default_space, provenance: list = None) -> dict:
+    '''
+    Save the probability of each RGB triplet as a native model file
+
+    `probability` is anything reshapeable to a flat LUT (eg. the 256x256x256 histogram).
+    Its size tells the quantization of the model in the colour space `space`,
+    both recorded in the header. `provenance` lists the models a derived model is built from
+
+    float32 halves the size of the float64 probabilities in CSV models, rounding
+    each probability to ~7 significant digits
+
+    Return the header written along with the LUT
+    '''
+    lut = np.array(probability, dtype=dtype).reshape(-1)
+    bits = lut_bits(lut.size, space)
+    # 0/0 gives a negative NaN, parsing a CSV gives a positive one: keep the hash independent of it
+    lut[np.isnan(lut)] = np.nan
+
+    if dataset is None:
+        dataset = os.path.splitext(os.path.basename(filename))[0]
+
+    header = {
+        'version': format_version,
+        'dataset': dataset,
+        'images': images,
+        'dtype': lut.dtype.name,
+        'size': lut.size,
+        'bits': bits,
+        'colour_space': space,
+        'hash': hash_lut(lut),
+    }
+    if provenance is not None:
+        header['provenance'] = provenance
+
+    np.save(filename, lut)
+    with open(header_filename(filename), 'w') as f:
+        json.dump(header, f, sort_keys = True, indent = 4)
+    return header
+
+def read_csv_model(filename: str) -> np.ndarray:
+    '''Return the flat LUT of a CSV model file (rows are sorted by R, G, B)'''
+    probability = pd.read_csv(filename, usecols=['Probability'], dtype={'Probability': np.float64})
+    lut = probability['Probability'].to_numpy()
+    assert lut.size == lut_size, f'Invalid CSV model: {filename} has {lut.size} rows'
+    return lut
+
+def load_model(filename: str, mmap: bool = True) -> np.ndarray:
+    '''
+    Return the flat probability LUT of a model file, either native, sparse or CSV
+
+    Native models are memory-mapped read-only unless `mmap` is False,
+    sparse models are expanded to a float32 LUT
+    '''
+    assert os.path.isfile(filename), critical('Model file not existing: ' + filename)
+
+    if filename.endswith(native_ext):
+        info('Reading model...')
+        return np.load(filename, mmap_mode='r' if mmap else None)
+    elif filename.endswith(sparse_ext):
+        # same float32 LUT as a native model trained on the same data
+        keys, probability = load_sparse_model(filename)
+        lut = np.full(read_header(filename)['size'], np.nan, dtype=np.float32)
+        lut[keys] = probability
+        return lut
+    else:
+        info('Reading CSV...')
+        return read_csv_model(filename)
+
+def convert_model(csv_filename: str, out: str = None, dtype: str = 'float32') -> dict:
+    '''
+    Convert a CSV model file into the native format
+
+    Return the header of the new model
+    '''
+    if out is None:
+        out = os.path.splitext(csv_filename)[0] + native_ext
+
+    info(f'Converting {csv_filename} to {out}')
+    lut = read_csv_model(csv_filename)
+    # the CSV does not track how many images the model was trained on
+    return save_model(lut, out, images=None, dtype=dtype)
+
+def share_model(filename: str) -> str:
+    '''
+    Make a model file loadable by many processes with no copy, and return the file they should load
+
+    Native models are memory-mapped read-only, so every process already shares
+    the same page cache. CSV and sparse models are loaded once and written as native
+    models into `shared_dir`, keeping the precision of their probabilities
+    '''
+    if filename.endswith(native_ext):
+        return filename
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    shared = os.path.join(shared_dir, f'skin-{os.getpid()}-{name}{native_ext}')
+    lut = load_model(filename)
+    space = read_header(filename).get('colour_space', default_space) if filename.endswith(sparse_ext) \
+        else default_space
+    try:
+        save_model(lut, shared, dataset=name, dtype=lut.dtype.name, space=space)
+    except Exception:
+        # do not leave a partial copy behind
+        unshare_model(filename, shared)
+        raise
+    info(f'Model {filename} shared as {shared}')
+    return shared
+
+def unshare_model(filename: str, shared: str):
+    '''Remove the shared copy of a model file, if `share_model` made one'''
+    if shared == filename:
+        return
+    for f in (shared, header_filename(shared)):
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+def open_model(filename: str, threshold: float = default_threshold, mmap: bool = True,
+               sparse: bool = False):
+    '''
+    Load a model file, either native, sparse or CSV, ready to infer at the given threshold
+
+    With `sparse`, the model is queried by binary searches instead of a dense decision table
+    '''
+    header = None
+    if filename.endswith(sparse_ext) or (filename.endswith(native_ext) and
+                                         os.path.isfile(header_filename(filename))):
+        header = read_header(filename)
+    if sparse:
+        keys, probability = load_sparse_model(filename)
+        return sparse_skin_model(keys, probability, header, threshold)
+    lut = load_model(filename, mmap=mmap)
+    return skin_model(lut, header, threshold)
+
+
+def model_layout(filename: str) -> tuple:
+    '''Return (bits per channel, colour space) of the LUT of a model file, without loading it'''
+    if filename.endswith(sparse_ext) or (filename.endswith(native_ext) and
+                                         os.path.isfile(header_filename(filename))):
+        header = read_header(filename)
+        space = header.get('colour_space', default_space)
+        return lut_bits(header['size'], space), space
+    if filename.endswith(native_ext):
+        return lut_bits(np.load(filename, mmap_mode='r').size), default_space
+    # CSV models are RGB and not quantized
+    return default_bits, default_space
+
+def model_nbytes(filename: str) -> int:
+    '''Return the memory taken by a model file once opened (see `skin_model.nbytes`), without loading it'''
+    if filename.endswith(native_ext):
+        lut = np.load(filename, mmap_mode='r')
+        size, itemsize = lut.size, lut.itemsize
+    elif filename.endswith(sparse_ext):
+        # expanded to a float32 LUT
+        size, itemsize = read_header(filename)['size'], np.dtype(np.float32).itemsize
+    else:
+        size, itemsize = lut_size, np.dtype(np.float64).itemsize
+    # probability LUT, and decision table of 1 bit per colour
+    return size * itemsize + (size + 7) // 8
+
+def model_groups(filenames: list, max_bytes: int = cache_max_bytes) -> list:
+    '''
+    Split model files into groups, in order, each of which fits in `max_bytes` once loaded
+
+    A model bigger than `max_bytes` makes a group by itself
+    '''
+    groups = []
+    group_bytes = 0
+    for filename in filenames:
+        nbytes = model_nbytes(filename)
+        if not groups or group_bytes + nbytes > max_bytes:
+            if nbytes > max_bytes:
+                warning(f'Model {filename} takes {nbytes / 1024 ** 2:.0f} MB, more than the cache cap')
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(filename)
+        group_bytes += nbytes
+    return groups
+
+
+class skin_model(object):
+    '''
+    Abstraction of a trained model
+
+    Inference does not read the probability LUT (64-128 MB) but a decision table
+    precomputed for the current threshold, which packs 1 bit per colour (2 MB)
+    '''
+    def __init__(self, lut: np.ndarray, header: dict = None, threshold: float = default_threshold):
+        self.lut = lut
+        self.header = header
+        # models older than colour spaces are RGB
+        self.space = header.get('colour_space', default_space) if header else default_space
+        self.bits = lut_bits(lut.size, self.space)
+        self.threshold = None
+        self.decisions = None
+        self.set_threshold(threshold)
+
+    def set_threshold(self, threshold: float):
+        '''Rebuild the decision table if the threshold changes'''
+        if threshold == self.threshold:
+            return
+        self.decisions = np.packbits(~below_threshold(self.lut, threshold), bitorder='little')
+        self.threshold = threshold
+
+    def index(self, im_data: np.ndarray) -> np.ndarray:
+        '''Return the LUT index of each pixel of an RGB image'''
+        return colour_index(im_data, self.bits, self.space)
+
+    def is_skin(self, idx: np.ndarray) -> np.ndarray:
+        '''Return a boolean array, True where the colour of LUT index `idx` is skin'''
+        shift = (idx & 7).astype(np.uint8)
+        return ((self.decisions[idx >> 3] >> shift) & 1).view(bool)
+
+    def skin_probability(self, idx: np.ndarray) -> np.ndarray:
+        '''Return the skin probability of the colours of LUT index `idx`, NaN if never seen in training'''
+        return self.lut[idx]
+
+    def nbytes(self) -> int:
+        return self.lut.nbytes + self.decisions.nbytes
+
+
+class sparse_skin_model(object):
+    '''
+    Trained model queried without expanding its LUT, for memory-constrained inference
+
+    Memory scales with the colours seen in training: for the current threshold
+    only the sorted indexes of non skin colours are kept, and looked up by binary search
+    '''
+    def __init__(self, keys: np.ndarray, probability: np.ndarray, header: dict = None,
+                 threshold: float = default_threshold):
+        self.keys = keys
+        self.probability = probability
+        self.header = header
+        self.space = header.get('colour_space', default_space) if header else default_space
+        self.bits = lut_bits(header['size'], self.space) if header else default_bits
+        self.threshold = None
+        self.non_skin_keys = None
+        self.set_threshold(threshold)
+
+    def set_threshold(self, threshold: float):
+        '''Rebuild the non skin colours if the threshold changes'''
+        if threshold == self.threshold:
+            return
+        self.non_skin_keys = self.keys[below_threshold(self.probability, threshold)]
+        self.threshold = threshold
+
+    def index(self, im_data: np.ndarray) -> np.ndarray:
+        '''Return the LUT index of each pixel of an RGB image'''
+        return colour_index(im_data, self.bits, self.space)
+
+    def is_skin(self, idx: np.ndarray) -> np.ndarray:
+        '''Return a boolean array, True where the colour of LUT index `idx` is skin'''
+        if self.non_skin_keys.size == 0:
+            return np.ones(idx.shape, dtype=bool)
+        pos = np.searchsorted(self.non_skin_keys, idx)
+        np.minimum(pos, self.non_skin_keys.size - 1, out=pos)
+        return self.non_skin_keys[pos] != idx
+
+    def skin_probability(self, idx: np.ndarray) -> np.ndarray:
+        '''Return the skin probability of the colours of LUT index `idx`, NaN if never seen in training'''
+        probability = np.full(idx.shape, np.nan, dtype=np.float32)
+        if self.keys.size == 0:
+            return probability
+        pos = np.searchsorted(self.keys, idx)
+        np.minimum(pos, self.keys.size - 1, out=pos)
+        seen = self.keys[pos] == idx
+        probability[seen] = self.probability[pos[seen]]
+        return probability
+
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.probability.nbytes + self.non_skin_keys.nbytes
+
+
+class model_cache(object):
+    '''
+    Process-wide cache of loaded models, so that each model file is read once
+
+    Models are keyed by path, mtime and size: a retrained model is loaded again.
+    The least recently used models are evicted when the cache exceeds `max_bytes`
+    '''
+    def __init__(self, max_bytes: int = cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filename: str) -> tuple:
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+    def nbytes(self) -> int:
+        return sum(m.nbytes() for m in self.models.values())
+
+    def get(self, filename: str, threshold: float = default_threshold) -> skin_model:
+        '''Return the model of the given file, loading it only if it is not cached'''
+        assert os.path.isfile(filename), critical('Model file not existing: ' + filename)
+        key = self.key(filename)
+
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            model = self.models[key]
+            model.set_threshold(threshold)
+            info(f'Model cache hit: {filename} (hits={self.hits}, misses={self.misses})')
+            return model
+
+        self.misses += 1
+        info(f'Model cache miss: {filename} (hits={self.hits}, misses={self.misses})')
+        # forget older versions of the same file
+        for k in [k for k in self.models if k[0] == key[0]]:
+            del self.models[k]
+
+        model = open_model(filename, threshold)
+        self.models[key] = model
+        # evict least recently used models, but always keep the requested one
+        while len(self.models) > 1 and self.nbytes() > self.max_bytes:
+            evicted, _ = self.models.popitem(last=False)
+            info(f'Model cache eviction: {evicted[0]}')
+        return model
+
+
+models_cache = model_cache()